@@ -1,4 +1,9 @@
+# Core
+import logging
+import os
+
 # Third party
+import prometheus_client
 import requests
 
 # Local
@@ -6,7 +11,49 @@ import helpers
 import feeds
 
 
-API_URL = "https://admin.insights.ubuntu.com/wp-json/wp/v2"
+# Prometheus metric exporters
+api_cache_lookups = prometheus_client.Counter(
+    "api_cache_lookups",
+    "A counter of API requests, by endpoint and whether the cache served them",
+    ["endpoint", "result"],
+)
+
+# Set INSIGHTS_API_URL to use another API, e.g. benchmarks/wordpress.py
+API_URL = os.environ.get(
+    "INSIGHTS_API_URL", "https://admin.insights.ubuntu.com/wp-json/wp/v2"
+)
+
+# Exclude "lang:jp" tagged posts by default
+EXCLUDED_TAG_IDS = [3184]
+
+# Pages listing posts only show their summaries, so they only need
+# these fields, with the authors and featured images embedded.
+# WordPress only embeds resources if "_links" is included.
+LISTING_FIELDS = [
+    "id",
+    "date",
+    "link",
+    "title",
+    "excerpt",
+    "author",
+    "group",
+    "categories",
+    "_start_day",
+    "_start_month",
+    "_start_year",
+    "_end_day",
+    "_end_month",
+    "_end_year",
+    "_event_venue",
+    "_event_location",
+    "_links",
+    "_embedded",
+]
+LISTING_EMBEDS = ["author", "wp:featuredmedia"]
+
+# WordPress before 5.4 leaves out "_embedded" when given "_fields",
+# so once that's seen, listings request whole posts instead
+embeds_with_fields = True
 
 
 def _embed_resource_data(resource):
@@ -25,14 +72,26 @@ def _normalise_resources(posts):
     return posts
 
 
-def get(endpoint, parameters={}):
+def get(endpoint, parameters={}, fresh=False):
     """
-    Query the Insights API (admin.insights.ubuntu.com) using the cache
+    Query the Insights API (admin.insights.ubuntu.com) using the cache,
+    or with `fresh`, from the API itself (see feeds.fresh_request)
     """
 
-    return feeds.cached_request(
-        helpers.build_url(API_URL, endpoint, parameters)
-    )
+    url = helpers.build_url(API_URL, endpoint, parameters)
+
+    if fresh:
+        response = feeds.fresh_request(url)
+    else:
+        response = feeds.cached_request(url)
+
+    # E.g. "posts", or "group" for "group/1479"
+    api_cache_lookups.labels(
+        endpoint=endpoint.split("/")[0],
+        result="hit" if getattr(response, "from_cache", False) else "miss",
+    ).inc()
+
+    return response
 
 
 def get_topics(post_id):
@@ -42,7 +101,7 @@ def get_topics(post_id):
 
     response = get("topic", {"post": post_id})
 
-    return response.json()
+    return feeds.decoded_json(response)
 
 
 def get_tags(slugs=[], post_id=""):
@@ -55,7 +114,7 @@ def get_tags(slugs=[], post_id=""):
         endpoint="tags", parameters={"slug": ",".join(slugs), "post": post_id}
     )
 
-    return response.json()
+    return feeds.decoded_json(response)
 
 
 def get_posts(
@@ -67,12 +126,14 @@ def get_posts(
     group_ids=[],
     category_ids=[],
     tag_ids=[],
-    # Exclude "lang:jp" tagged posts
-    tags_exclude_ids=[3184],
+    tags_exclude_ids=EXCLUDED_TAG_IDS,
     author_ids=[],
     before=None,
     after=None,
     exclude=None,
+    fields=None,
+    embeds=None,
+    prepare=_normalise_resources,
 ):
     """
     Get posts by querying the Wordpress API,
@@ -82,13 +143,28 @@ def get_posts(
     returning empty data instead of an error.
 
     Allow filtering on various criteria, using sensible defaults.
+
+    By default, posts have all their fields and embedded resources.
+    Pass `fields` and `embeds` (e.g. LISTING_FIELDS and LISTING_EMBEDS)
+    to only get those.
+
+    The posts from each response are prepared once, and kept
+    (see feeds.decoded_json). Pass `prepare` to turn them into something
+    other than normalised dicts, e.g. with helpers.format_posts.
     """
 
+    global embeds_with_fields
+
+    if fields and embeds and not embeds_with_fields:
+        fields = None
+        embeds = None
+
     try:
         response = get(
             "posts",
             {
-                "_embed": True,
+                "_embed": ",".join(embeds) if embeds else True,
+                "_fields": ",".join(fields) if fields else None,
                 "per_page": per_page,
                 "page": page,
                 "search": query,
@@ -119,36 +195,79 @@ def get_posts(
             # We don't recognise this error, re-raise it
             raise request_error
     else:
-        posts = response.json()
+        if (
+            fields
+            and embeds
+            and response.content.strip() not in [b"", b"[]"]
+            and b'"_embedded"' not in response.content
+        ):
+            logging.getLogger(__name__).warning(
+                "The API doesn't embed resources with _fields, "
+                "so requesting whole posts"
+            )
+            embeds_with_fields = False
+
+            return get_posts(
+                page=page,
+                per_page=per_page,
+                query=query,
+                sticky=sticky,
+                slugs=slugs,
+                group_ids=group_ids,
+                category_ids=category_ids,
+                tag_ids=tag_ids,
+                tags_exclude_ids=tags_exclude_ids,
+                author_ids=author_ids,
+                before=before,
+                after=after,
+                exclude=exclude,
+                prepare=prepare,
+            )
+
+        posts = feeds.decoded_json(response, prepare=prepare)
         total_pages = helpers.to_int(
             response.headers.get("X-WP-TotalPages"), None
         )
         total_posts = helpers.to_int(response.headers.get("X-WP-Total"), None)
 
-    posts = _normalise_resources(posts)
-
     return posts, total_posts, total_pages
 
 
 def get_category(category_id):
-    return get("categories/" + str(category_id)).json()
+    return feeds.decoded_json(get("categories/" + str(category_id)))
 
 
-def get_categories(slugs=[]):
-    response = get("categories", {"slug": ",".join(slugs)})
+def get_categories(slugs=[], ids=[]):
+    response = get(
+        "categories",
+        {
+            "slug": ",".join(slugs),
+            "include": helpers.join_ids(sorted(ids)),
+            "per_page": 100 if ids else None,
+        },
+    )
 
-    return response.json()
+    return feeds.decoded_json(response)
 
 
 def get_users(slugs=[]):
     response = get("users", {"slug": ",".join(slugs)})
 
-    return response.json()
+    return feeds.decoded_json(response)
 
 
 def get_group(group_id):
-    return get("group/" + str(group_id)).json()
+    return feeds.decoded_json(get("group/" + str(group_id)))
+
 
+def get_groups(slugs=[], ids=[]):
+    response = get(
+        "group",
+        {
+            "slug": ",".join(slugs),
+            "include": helpers.join_ids(sorted(ids)),
+            "per_page": 100 if ids else None,
+        },
+    )
 
-def get_groups(slugs=[]):
-    return get("group", {"slug": ",".join(slugs)}).json()
+    return feeds.decoded_json(response)
@@ -1,5 +1,4 @@
 # Core
-import dateutil.parser
 from datetime import datetime
 from urllib.parse import urlparse, urlunparse, unquote
 
@@ -10,9 +9,15 @@ from dateutil.relativedelta import relativedelta
 
 # Local
 import api
+import fanout
 import feeds
 import helpers
+import page_cache
 import redirects
+import related
+import taxonomy
+import timing
+import warmup
 
 
 INSIGHTS_ADMIN_URL = "https://admin.insights.ubuntu.com"
@@ -22,6 +27,7 @@ app.jinja_env.filters["monthname"] = helpers.monthname
 app.url_map.strict_slashes = False
 app.url_map.converters["regex"] = helpers.RegexConverter
 talisker.flask.register(app)
+timing.register(app)
 
 apply_redirects = redirects.prepare_redirects(
     permanent_redirects_path="permanent-redirects.yaml",
@@ -37,12 +43,11 @@ def _tag_view(tag_slug, page_slug, template):
     """
 
     page = helpers.to_int(flask.request.args.get("page"), default=1)
-    tags = api.get_tags(slugs=[tag_slug])
+    tag = taxonomy.tags.get_by_slug(tag_slug)
 
-    if not tags:
+    if not tag:
         flask.abort(404)
 
-    tag = tags[0]
     posts, total_posts, total_pages = helpers.get_formatted_expanded_posts(
         tag_ids=[tag["id"]], page=page
     )
@@ -67,19 +72,14 @@ def _group_view(group_slug, page_slug, template):
     page = int(flask.request.args.get("page") or "1")
     category_slug = flask.request.args.get("category")
 
-    groups = api.get_groups(slugs=[group_slug])
+    group = taxonomy.groups.get_by_slug(group_slug)
     category = None
 
-    if not groups:
+    if not group:
         flask.abort(404)
 
-    group = groups[0]
-
     if category_slug:
-        categories = api.get_categories(slugs=[category_slug])
-
-        if categories:
-            category = categories[0]
+        category = taxonomy.categories.get_by_slug(category_slug)
 
     posts, total_posts, total_pages = helpers.get_formatted_expanded_posts(
         group_ids=[group["id"]],
@@ -120,7 +120,8 @@ def clear_trailing():
 def status():
     """
     A simple response to test that the app is alive and working.
-    This can be targeted by Kubernetes readiness and liveness checks.
+    This can be targeted by Kubernetes liveness checks,
+    while readiness checks use /status/ready.
     As used in snapcraft.io:
     https://github.com/canonical-websites/snapcraft.io/pull/327/files
     """
@@ -128,39 +129,84 @@ def status():
     return "alive"
 
 
-@app.route("/")
-def homepage():
-    category_slug = flask.request.args.get("category")
+@app.route("/status/ready")
+def status_ready():
+    """
+    For Kubernetes readiness checks only.
+    Until every worker has warmed up its cache (see warmup.py),
+    whichever one answers responds with a 503, so no traffic is sent.
+    Liveness checks should use /status, so slow warm-ups don't restart it.
+    """
+
+    if not warmup.is_ready():
+        return "warming up", 503
+
+    return "ready"
 
-    category = None
-    sticky_posts, _, _ = helpers.get_formatted_expanded_posts(sticky=True)
-    featured_posts = sticky_posts[:3] if sticky_posts else None
-    page = helpers.to_int(flask.request.args.get("page"), default=1)
-    posts_per_page = 12
 
-    upcoming_categories = api.get_categories(slugs=["events", "webinars"])
-    upcoming_category_ids = []
+def _get_upcoming_category_ids():
+    """
+    Get the IDs of the categories which hold upcoming events
+    """
+
+    upcoming_categories = taxonomy.categories.get_resources(
+        slugs=["events", "webinars"]
+    )
 
-    for upcoming_category_id in upcoming_categories:
-        upcoming_category_ids.append(upcoming_category_id["id"])
+    return [category["id"] for category in upcoming_categories]
 
+
+def _get_upcoming_events():
     upcoming_events, _, _ = helpers.get_formatted_expanded_posts(
-        per_page=3, category_ids=upcoming_category_ids
+        per_page=3, category_ids=_get_upcoming_category_ids()
     )
 
-    if category_slug:
-        categories = api.get_categories(slugs=[category_slug])
+    return upcoming_events
+
+
+def _get_category_and_posts(category_slug, **kwargs):
+    """
+    Look up the category for a slug, if provided,
+    and then get the posts, filtered by that category
+    """
+
+    category = None
 
-        if categories:
-            category = categories[0]
+    if category_slug:
+        category = taxonomy.categories.get_by_slug(category_slug)
 
     posts, total_posts, total_pages = helpers.get_formatted_expanded_posts(
-        per_page=posts_per_page,
-        category_ids=[category["id"]] if category else [],
-        page=page,
-        sticky=False,
+        category_ids=[category["id"]] if category else [], **kwargs
     )
 
+    return category, posts, total_posts, total_pages
+
+
+@app.route("/")
+@page_cache.cached(timeout=300)
+def homepage():
+    category_slug = flask.request.args.get("category")
+    page = helpers.to_int(flask.request.args.get("page"), default=1)
+    posts_per_page = 12
+
+    with fanout.FanOut("homepage") as fan:
+        sticky_request = fan.submit(
+            helpers.get_formatted_expanded_posts, sticky=True
+        )
+        upcoming_request = fan.submit(_get_upcoming_events)
+        posts_request = fan.submit(
+            _get_category_and_posts,
+            category_slug,
+            per_page=posts_per_page,
+            page=page,
+            sticky=False,
+        )
+
+    sticky_posts, _, _ = sticky_request.result()
+    featured_posts = sticky_posts[:3] if sticky_posts else None
+    upcoming_events = upcoming_request.result()
+    category, posts, total_posts, total_pages = posts_request.result()
+
     # Manipulate the posts to add a newsletter placeholder
     if page == 1:
         print("page: " + str(page))
@@ -203,8 +249,9 @@ def search():
 
 
 @app.route("/press-centre")
+@page_cache.cached(timeout=600)
 def press_centre():
-    group = api.get_groups(slugs=["canonical-announcements"])[0]
+    group = taxonomy.groups.get_by_slug("canonical-announcements")
 
     posts, total_posts, total_pages = helpers.get_formatted_expanded_posts(
         group_ids=[group["id"]]
@@ -220,6 +267,7 @@ def press_centre():
 
 
 @app.route("/cloud-and-server")
+@page_cache.cached(timeout=600)
 def cloud_and_server():
     return _group_view(
         page_slug="cloud-and-server",
@@ -229,6 +277,7 @@ def cloud_and_server():
 
 
 @app.route("/internet-of-things")
+@page_cache.cached(timeout=600)
 def internet_of_things():
     return _group_view(
         page_slug="internet-of-things",
@@ -238,6 +287,7 @@ def internet_of_things():
 
 
 @app.route("/desktop")
+@page_cache.cached(timeout=600)
 def desktop():
     return _group_view(
         page_slug="desktop", group_slug="desktop", template="desktop.html"
@@ -245,11 +295,13 @@ def desktop():
 
 
 @app.route("/tag/<slug>")
+@page_cache.cached(timeout=600)
 def tag(slug):
     return _tag_view(tag_slug=slug, page_slug="tag", template="tag.html")
 
 
 @app.route("/topics/design")
+@page_cache.cached(timeout=600)
 def design():
     return _tag_view(
         tag_slug="design", page_slug="topics", template="topics/design.html"
@@ -257,6 +309,7 @@ def design():
 
 
 @app.route("/topics/juju")
+@page_cache.cached(timeout=600)
 def juju():
     return _tag_view(
         tag_slug="juju", page_slug="topics", template="topics/juju.html"
@@ -264,6 +317,7 @@ def juju():
 
 
 @app.route("/topics/maas")
+@page_cache.cached(timeout=600)
 def maas():
     return _tag_view(
         tag_slug="maas", page_slug="topics", template="topics/maas.html"
@@ -271,6 +325,7 @@ def maas():
 
 
 @app.route("/topics/snappy")
+@page_cache.cached(timeout=600)
 def snappy():
     return _tag_view(
         tag_slug="snappy", page_slug="topics", template="topics/snappy.html"
@@ -278,6 +333,7 @@ def snappy():
 
 
 @app.route("/archives")
+@page_cache.cached(timeout=600)
 def archives():
     page = helpers.to_int(flask.request.args.get("page"), default=1)
     year = helpers.to_int(flask.request.args.get("year"))
@@ -304,13 +360,10 @@ def archives():
             friendly_date = after.strftime("%Y")
 
     if group_slug:
-        groups = api.get_groups(slugs=[group_slug])
-
-        if groups:
-            group = groups[0]
+        group = taxonomy.groups.get_by_slug(group_slug)
 
     if category_slug:
-        categories = api.get_categories(slugs=[category_slug])
+        categories = taxonomy.categories.get_resources(slugs=[category_slug])
         category_ids = [category["id"] for category in categories]
     else:
         categories = []
@@ -344,16 +397,15 @@ def archives():
 @app.route("/feed")
 def feed(type=None, slug=None):  # noqa
     feed_url = "".join([INSIGHTS_ADMIN_URL, flask.request.full_path])
-    feed_text = feeds.cached_request(feed_url).text
-
-    feed_text = feed_text.replace(
-        "admin.insights.ubuntu.com", "insights.ubuntu.com"
+    feed_body = feeds.stream_rewritten(
+        feed_url, b"admin.insights.ubuntu.com", b"insights.ubuntu.com"
     )
 
-    return flask.Response(feed_text, mimetype="text/xml")
+    return flask.Response(feed_body, mimetype="text/xml")
 
 
 @app.route("/author/<slug>")
+@page_cache.cached(timeout=3600)
 def user(slug):
     authors = api.get_users(slugs=[slug])
 
@@ -371,6 +423,30 @@ def user(slug):
     )
 
 
+def _get_tags_and_related_posts(post):
+    """
+    Get the tags for a post, and then up to 3 other posts sharing those tags.
+    Both come from the local indexes, unless the related posts index
+    hasn't loaded yet, when they're requested from the API.
+    """
+
+    tag_ids = post.tags or []
+    related_posts = related.index.get_related(post.id, tag_ids, count=3)
+
+    if related_posts is not None:
+        tags = taxonomy.tags.get_resources(ids=tag_ids)
+
+        # In the same order as the API
+        return sorted(tags, key=lambda tag: tag["name"].lower()), related_posts
+
+    tags = api.get_tags(post_id=post.id)
+    related_posts, _, _ = helpers.get_formatted_posts(
+        tag_ids=[tag["id"] for tag in tags], per_page=3, exclude=post.id
+    )
+
+    return tags, related_posts
+
+
 @app.route(
     '/<regex("[0-9]{4}"):year>/<regex("[0-9]{2}"):month>/'
     '<regex("[0-9]{2}"):day>/<slug>'
@@ -379,14 +455,17 @@ def user(slug):
 @app.route('/<regex("[0-9]{4}"):year>/<slug>')
 @app.route("/webinar/<slug>")
 @app.route("/<slug>")
+@page_cache.cached(timeout=3600)
 def post(slug, year=None, month=None, day=None):
-    posts, total_posts, total_pages = helpers.get_formatted_posts(slugs=[slug])
+    posts, total_posts, total_pages = helpers.get_formatted_posts(
+        slugs=[slug], listing=False
+    )
 
     if not posts:
         flask.abort(404)
 
     if not (day and month and year):
-        pubdate = dateutil.parser.parse(posts[0]["date_gmt"])
+        pubdate = helpers.parse_date(posts[0].date_gmt)
         day = pubdate.strftime("%d")
         month = pubdate.strftime("%m")
         year = pubdate.strftime("%Y")
@@ -397,15 +476,16 @@ def post(slug, year=None, month=None, day=None):
 
     post = posts[0]
 
-    topics = api.get_topics(post_id=post["id"])
+    with fanout.FanOut("post") as fan:
+        topics_request = fan.submit(api.get_topics, post_id=post.id)
+        tags_request = fan.submit(_get_tags_and_related_posts, post)
+
+    topics = topics_request.result()
 
     if topics:
-        post["topic"] = topics[0]
+        post.topic = topics[0]
 
-    tags = api.get_tags(post_id=post["id"])
-    related_posts, total_posts, total_pages = helpers.get_formatted_posts(
-        tag_ids=[tag["id"] for tag in tags], per_page=3, exclude=post["id"]
-    )
+    tags, related_posts = tags_request.result()
 
     # Even though we're filtering tags below, we need to know the snapcraft.io
     # tag, specifically to add the canonical meta tag
@@ -427,22 +507,15 @@ def post(slug, year=None, month=None, day=None):
 
 
 @app.route("/upcoming")
+@page_cache.cached(timeout=600)
 def upcoming():
     page = helpers.to_int(flask.request.args.get("page"), default=1)
     posts_per_page = 12
 
-    upcoming_categories = api.get_categories(slugs=["events", "webinars"])
-    upcoming_category_ids = []
-
-    for upcoming_category_id in upcoming_categories:
-        upcoming_category_ids.append(upcoming_category_id["id"])
-
-    upcoming_events, _, _ = helpers.get_formatted_expanded_posts(
-        per_page=3, category_ids=upcoming_category_ids
-    )
-
     posts, total_posts, total_pages = helpers.get_formatted_expanded_posts(
-        per_page=posts_per_page, category_ids=upcoming_category_ids, page=page
+        per_page=posts_per_page,
+        category_ids=_get_upcoming_category_ids(),
+        page=page,
     )
 
     return flask.render_template(
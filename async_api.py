@@ -0,0 +1,110 @@
+# Core
+import asyncio
+import functools
+import os
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+# Third-party
+import prometheus_client
+
+# Local
+import api
+import timing
+
+
+# Prometheus metric exporters
+async_api_waiting = prometheus_client.Gauge(
+    "async_api_waiting",
+    "The number of API calls waiting for a connection to their host",
+)
+
+# Async client settings
+# Run at most ASYNC_API_MAX_PER_HOST calls to the API host at once,
+# failing any which take longer than ASYNC_API_TIMEOUT_SECONDS in total
+max_per_host = int(os.environ.get("ASYNC_API_MAX_PER_HOST", 8))
+timeout = int(os.environ.get("ASYNC_API_TIMEOUT_SECONDS", 20))
+
+# The threads which make the calls, each using a pooled keep-alive
+# connection from feeds.cached_session
+executor = ThreadPoolExecutor(max_workers=max_per_host)
+
+# event loop -> {host: semaphore}
+_host_semaphores = weakref.WeakKeyDictionary()
+
+
+def _coroutine(function):
+    """
+    Turn a function from api.py into a coroutine with the same signature,
+    which makes the call through the same cache, retries and coalescing.
+
+    A call which times out keeps its place in the host's limit until its
+    thread finishes, as the thread can't be stopped.
+    """
+
+    @functools.wraps(function)
+    async def coroutine(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        semaphore = _host_semaphore(loop, urlparse(api.API_URL).netloc)
+
+        async_api_waiting.inc()
+
+        try:
+            await semaphore.acquire()
+        finally:
+            async_api_waiting.dec()
+
+        try:
+            call = loop.run_in_executor(
+                executor,
+                timing.carry(functools.partial(function, *args, **kwargs)),
+            )
+        except Exception as executor_error:
+            semaphore.release()
+            raise executor_error
+
+        call.add_done_callback(
+            functools.partial(_finish_call, semaphore=semaphore)
+        )
+
+        return await asyncio.wait_for(asyncio.shield(call), timeout)
+
+    return coroutine
+
+
+def _finish_call(call, semaphore):
+    semaphore.release()
+
+    if not call.cancelled():
+        # Mark any error as seen, in case the caller timed out
+        call.exception()
+
+
+def _host_semaphore(loop, host):
+    """
+    Semaphores belong to an event loop, so keep one per host per loop
+    """
+
+    semaphores = _host_semaphores.setdefault(loop, {})
+
+    if host not in semaphores:
+        semaphores[host] = asyncio.Semaphore(max_per_host)
+
+    return semaphores[host]
+
+
+# Coroutine versions of the functions in api.py, to gather concurrently:
+#
+#     (posts, _, _), tags = await asyncio.gather(
+#         async_api.get_posts(per_page=3), async_api.get_tags(slugs=["lxd"])
+#     )
+get = _coroutine(api.get)
+get_topics = _coroutine(api.get_topics)
+get_tags = _coroutine(api.get_tags)
+get_posts = _coroutine(api.get_posts)
+get_category = _coroutine(api.get_category)
+get_categories = _coroutine(api.get_categories)
+get_users = _coroutine(api.get_users)
+get_group = _coroutine(api.get_group)
+get_groups = _coroutine(api.get_groups)
@@ -0,0 +1,103 @@
+"""
+Compare decoding API responses on every cache hit
+with keeping the decoded JSON (feeds.decoded_json),
+first for single responses, then for whole warm-cache renders.
+
+Usage:
+
+    python3 -m benchmarks.decoded_json
+"""
+
+# Core
+import os
+import tempfile
+import timeit
+
+# Third-party
+import requests
+
+# Local
+from benchmarks.wordpress import FixtureServer, generate_fixtures
+
+
+RUNS = 200
+ROUTES = [
+    "/",
+    "/archives",
+    "/tag/security",
+    "/2018/01/24/meltdown-spectre-and-ubuntu-what-you-need-to-know",
+]
+
+
+def main():
+    server = FixtureServer(generate_fixtures(), latency=0, jitter=0)
+    server.start()
+
+    # The app reads these settings when it's imported
+    scratch_dir = tempfile.mkdtemp()
+    os.environ["INSIGHTS_API_URL"] = server.api_url
+    os.environ["FEED_CACHE_PATH"] = os.path.join(scratch_dir, "cache.sqlite")
+    os.environ["TAXONOMY_SNAPSHOT_DIR"] = scratch_dir
+
+    import api
+    import app
+    import feeds
+
+    app.app.logger.disabled = True
+
+    print("Single responses, per hit:")
+
+    for name, parameters in [
+        ("Full posts", {"_embed": True, "per_page": 12}),
+        (
+            "Listing posts",
+            {
+                "_embed": ",".join(api.LISTING_EMBEDS),
+                "_fields": ",".join(api.LISTING_FIELDS),
+                "per_page": 12,
+            },
+        ),
+    ]:
+        response = requests.get(server.api_url + "/posts", params=parameters)
+        feeds.decoded_json(response)
+
+        decoded = timeit.timeit(
+            lambda: api._normalise_resources(response.json()), number=RUNS
+        )
+        kept = timeit.timeit(lambda: feeds.decoded_json(response), number=RUNS)
+
+        print(
+            "{} ({}KB): decoded {:.3f}ms, kept {:.3f}ms".format(
+                name,
+                len(response.content) // 1024,
+                decoded * 1e3 / RUNS,
+                kept * 1e3 / RUNS,
+            )
+        )
+
+    print("\nWarm-cache renders, per request:")
+
+    client = app.app.test_client()
+
+    for route in ROUTES:
+        assert client.get(route).status_code == 200
+
+        feeds.decoded_max_entries = 0
+        feeds.decoded_bodies.clear()
+        decoded = timeit.timeit(lambda: client.get(route), number=RUNS // 4)
+
+        feeds.decoded_max_entries = 200
+        client.get(route)
+        kept = timeit.timeit(lambda: client.get(route), number=RUNS // 4)
+
+        print(
+            "{:<60} decoded {:.2f}ms, kept {:.2f}ms".format(
+                route[:60], decoded * 4e3 / RUNS, kept * 4e3 / RUNS
+            )
+        )
+
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
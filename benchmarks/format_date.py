@@ -0,0 +1,73 @@
+"""
+Compare formatting the dates of 10,000 rendered posts with
+helpers.format_date and the dateutil parser it used to call every time.
+Posts are rendered many times, so there are only 2,000 distinct dates.
+
+Usage:
+
+    python3 -m benchmarks.format_date
+"""
+
+# Core
+import datetime
+import random
+import timeit
+
+# Third-party
+import dateutil.parser
+
+# Local
+from helpers import format_date, parse_date
+
+
+DATE_COUNT = 10000
+POST_COUNT = 2000
+
+
+def generate_dates(count):
+    """
+    Post dates as the API sends them, over a few years of publishing
+    """
+
+    start = datetime.datetime(2015, 1, 1)
+
+    return [
+        (
+            start
+            + datetime.timedelta(seconds=random.randrange(4 * 365 * 86400))
+        ).strftime("%Y-%m-%dT%H:%M:%S")
+        for _ in range(count)
+    ]
+
+
+def format_date_with_dateutil(date):
+    return dateutil.parser.parse(date).strftime("%-d %B %Y")
+
+
+def main():
+    random.seed(0)
+    post_dates = generate_dates(POST_COUNT)
+    dates = [random.choice(post_dates) for _ in range(DATE_COUNT)]
+
+    for date in dates:
+        assert format_date(date) == format_date_with_dateutil(date)
+
+    def format_with_empty_cache():
+        format_date.cache_clear()
+        return [format_date(date) for date in dates]
+
+    timings = [
+        ("dateutil", lambda: [format_date_with_dateutil(d) for d in dates]),
+        ("format_date", format_with_empty_cache),
+        ("(parse_date alone)", lambda: [parse_date(d) for d in dates]),
+    ]
+
+    print("{} dates".format(DATE_COUNT))
+
+    for name, function in timings:
+        seconds = timeit.timeit(function, number=3) / 3
+        print("{}: {:.1f}ms".format(name, seconds * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Compare rewriting the images in long synthetic post bodies
+with helpers.rewrite_images and the regexes it replaced.
+
+Usage:
+
+    python3 -m benchmarks.format_post
+"""
+
+# Core
+import random
+import re
+import timeit
+
+# Local
+from helpers import CLOUDINARY, rewrite_images
+
+
+POST_COUNT = 20
+PARAGRAPHS_PER_POST = 400
+IMAGE_EVERY = 8
+
+
+def generate_post(single_line):
+    """
+    A long article, with an image every few paragraphs -
+    some already served through cloudinary, as after an import.
+    WordPress sometimes renders a whole post onto a single line.
+    """
+
+    paragraphs = []
+
+    for index in range(PARAGRAPHS_PER_POST):
+        text = " ".join(
+            random.choice(["snap", "kernel", "ubuntu", "cloud", "lts", "the"])
+            for _ in range(random.randint(20, 80))
+        )
+        paragraphs.append("<p>{}</p>".format(text))
+
+        if index % IMAGE_EVERY == 0:
+            image_url = "https://insights.ubuntu.com/wp-content/{}.png".format(
+                index
+            )
+
+            if index % (IMAGE_EVERY * 2) == 0:
+                image_url = CLOUDINARY + "w_560/" + image_url
+
+            paragraphs.append(
+                '<p><img class="aligncenter" src="{}" alt="Image {}" '
+                'width="720" height="405" /></p>'.format(image_url, index)
+            )
+
+    return ("" if single_line else "\n").join(paragraphs)
+
+
+def rewrite_images_with_regexes(content):
+    content = re.sub(
+        r'img(.*)src="https://res.cloudinary.com/canonical'
+        r'(.[^http]*)/http(.[^"]*)"',
+        r'img\1 src="\3"',
+        content,
+    )
+
+    return re.sub(
+        r"img(.*) src=\"(.[^\"]*)\"",
+        r'img\1 decoding="async" src="{url}w_560/\2"'
+        r'srcset="{url}w_375/\2 375w,'
+        r'{url}w_480/\2 480w, {url}w_560/\2 560w"'
+        r'sizes="(max-width: 375px) 280px,'
+        r"(max-width: 480px) 440px,"
+        r'560px"'.format(url=CLOUDINARY),
+        content,
+    )
+
+
+def main():
+    random.seed(0)
+
+    for single_line in [False, True]:
+        posts = [generate_post(single_line) for _ in range(POST_COUNT)]
+
+        for post in posts:
+            assert rewrite_images(post) == rewrite_images_with_regexes(post)
+
+        scanned = timeit.timeit(
+            lambda: [rewrite_images(post) for post in posts], number=3
+        )
+        regexes = timeit.timeit(
+            lambda: [rewrite_images_with_regexes(post) for post in posts],
+            number=3,
+        )
+
+        per_post = 1e3 / (POST_COUNT * 3)
+        print(
+            "{} posts of {}KB, {}".format(
+                POST_COUNT,
+                sum(len(post) for post in posts) // POST_COUNT // 1024,
+                "on one line" if single_line else "one paragraph per line",
+            )
+        )
+        print("Scan:    {:.2f}ms per post".format(scanned * per_post))
+        print("Regexes: {:.2f}ms per post".format(regexes * per_post))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Measure the memory kept for posts (see feeds.decoded_json)
+as normalised WordPress dicts, and as formatted helpers.Post objects,
+with tracemalloc.
+
+The cache holds a mix like a busy worker's: pages of listings,
+and single posts with their content.
+
+Usage:
+
+    python3 -m benchmarks.post_model
+"""
+
+# Core
+import gc
+import os
+import tempfile
+import tracemalloc
+
+# Local
+from benchmarks.wordpress import FixtureServer, generate_fixtures
+
+
+LISTING_PAGES = 25
+SINGLE_POSTS = 50
+
+
+def fill_cache(api, prepare):
+    for page in range(1, LISTING_PAGES + 1):
+        api.get_posts(
+            page=page,
+            fields=api.LISTING_FIELDS,
+            embeds=api.LISTING_EMBEDS,
+            prepare=prepare,
+        )
+
+    for post_id in range(1, SINGLE_POSTS + 1):
+        api.get_posts(slugs=["post-{}".format(post_id)], prepare=prepare)
+
+
+def kept_bytes(api, feeds, prepare):
+    """
+    The memory kept after filling the cache,
+    from upstream responses already in the HTTP cache
+    """
+
+    feeds.decoded_bodies.clear()
+    gc.collect()
+    before, _ = tracemalloc.get_traced_memory()
+
+    fill_cache(api, prepare)
+
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+
+    return after - before
+
+
+def main():
+    fixtures = generate_fixtures()
+    server = FixtureServer(fixtures, latency=0, jitter=0)
+    server.start()
+
+    # The app reads these settings when it's imported
+    scratch_dir = tempfile.mkdtemp()
+    os.environ["INSIGHTS_API_URL"] = server.api_url
+    os.environ["FEED_CACHE_PATH"] = os.path.join(scratch_dir, "cache.sqlite")
+    os.environ["TAXONOMY_SNAPSHOT_DIR"] = scratch_dir
+
+    import api
+    import feeds
+    import helpers
+
+    for index, post in enumerate(fixtures["posts"][:SINGLE_POSTS]):
+        post["slug"] = "post-{}".format(index + 1)
+
+    # Fill the HTTP cache first, so only the kept posts are measured
+    fill_cache(api, api._normalise_resources)
+    tracemalloc.start()
+
+    dicts = kept_bytes(api, feeds, api._normalise_resources)
+    posts = kept_bytes(api, feeds, helpers.format_posts)
+
+    tracemalloc.stop()
+    server.stop()
+
+    print(
+        "{} listing pages and {} single posts kept:".format(
+            LISTING_PAGES, SINGLE_POSTS
+        )
+    )
+    print("WordPress dicts: {:.0f}KB".format(dicts / 1024))
+    print("Post objects:    {:.0f}KB".format(posts / 1024))
+
+
+if __name__ == "__main__":
+    main()
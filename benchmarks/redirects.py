@@ -0,0 +1,127 @@
+"""
+Compare matching paths against 10,000 synthetic redirect rules
+with the indexed YamlRegexMap and a linear scan of every rule.
+
+Usage:
+
+    python3 -m benchmarks.redirects
+"""
+
+# Core
+import os
+import random
+import tempfile
+import timeit
+
+# Local
+from redirects import YamlRegexMap
+
+
+RULE_COUNT = 10000
+PATH_COUNT = 1000
+
+
+def generate_rules(count):
+    """
+    A mix of the kinds of rules in redirects.yaml:
+    literal paths, regexes under a fixed first segment,
+    and regexes which could match any path
+    """
+
+    rules = []
+
+    for index in range(count):
+        kind = index % 10
+
+        if kind < 6:
+            rules.append(
+                ("/old-post-{}/?".format(index), "/new-post-{}".format(index))
+            )
+        elif kind < 9:
+            rules.append(
+                (
+                    "/section-{}/(?P<slug>[^/]+)/?".format(index % 200),
+                    "/archives?section={}&slug={{slug}}".format(index),
+                )
+            )
+        else:
+            rules.append(
+                (
+                    "/legacy-{}(?P<page>/.*)?".format(index),
+                    "https://example.com/legacy-{}{{page}}".format(index),
+                )
+            )
+
+    return rules
+
+
+def generate_paths(rules, count):
+    paths = []
+
+    for _ in range(count):
+        index = random.randrange(len(rules) * 2)
+
+        if index >= len(rules):
+            # A path which matches no rule, like most requests
+            paths.append("/2018/01/24/post-{}".format(index))
+        elif index % 10 < 6:
+            paths.append("/old-post-{}".format(index))
+        elif index % 10 < 9:
+            paths.append("/section-{}/some-slug".format(index % 200))
+        else:
+            paths.append("/legacy-{}/page".format(index))
+
+    return paths
+
+
+def linear_scan(redirect_map, url_path):
+    """
+    Match a path the way YamlRegexMap used to, trying every rule in turn
+    """
+
+    for match, target in redirect_map.matches:
+        result = match.fullmatch(url_path)
+
+        if result:
+            parts = {}
+            for name, value in result.groupdict().items():
+                parts[name] = value or ""
+
+            return target.format(**parts)
+
+
+def main():
+    random.seed(0)
+    rules = generate_rules(RULE_COUNT)
+    paths = generate_paths(rules, PATH_COUNT)
+
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as f:
+        for pattern, target in rules:
+            f.write('"{}": "{}"\n'.format(pattern, target))
+
+    try:
+        start = timeit.default_timer()
+        redirect_map = YamlRegexMap(f.name)
+        build_time = timeit.default_timer() - start
+    finally:
+        os.remove(f.name)
+
+    for path in paths:
+        assert redirect_map.find(path) == linear_scan(redirect_map, path)
+
+    indexed = timeit.timeit(
+        lambda: [redirect_map.find(path) for path in paths], number=3
+    )
+    scanned = timeit.timeit(
+        lambda: [linear_scan(redirect_map, path) for path in paths], number=3
+    )
+
+    per_path = 1e6 / (PATH_COUNT * 3)
+    print("{} rules, {} paths".format(RULE_COUNT, PATH_COUNT))
+    print("Index built in {:.2f}s".format(build_time))
+    print("Indexed:     {:.1f}us per path".format(indexed * per_path))
+    print("Linear scan: {:.1f}us per path".format(scanned * per_path))
+
+
+if __name__ == "__main__":
+    main()
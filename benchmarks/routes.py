@@ -0,0 +1,248 @@
+"""
+Load test every route in tests.tests.working_uris against
+the fixture API in benchmarks/wordpress.py, first with empty caches
+and then with warm caches, reporting throughput and latency percentiles.
+
+Usage:
+
+    python3 -m benchmarks.routes --concurrency 8 --latency 0.05
+    python3 -m benchmarks.routes --compare benchmarks/results/routes-abc.json
+
+Results are saved as JSON in benchmarks/results/, named by commit,
+to compare with later runs.
+"""
+
+# Core
+import argparse
+import datetime
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Local
+from benchmarks.wordpress import FixtureServer, generate_fixtures
+
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def percentile(sorted_values, percent):
+    """
+    The nearest-rank percentile of an already sorted list
+    """
+
+    rank = math.ceil(percent / 100 * len(sorted_values))
+
+    return sorted_values[max(rank, 1) - 1]
+
+
+def run_batch(app, server, uri, requests, concurrency):
+    """
+    Request a URI `requests` times, `concurrency` at a time
+    """
+
+    def timed_request(_):
+        start = time.time()
+        response = app.test_client().get(uri)
+
+        return time.time() - start, response.status_code
+
+    upstream_before = server.request_count
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed_request, range(requests)))
+
+    elapsed = time.time() - start
+    latencies = sorted(latency * 1000 for latency, _ in results)
+
+    return {
+        "requests": requests,
+        "errors": len([status for _, status in results if status >= 500]),
+        "upstream_requests": server.request_count - upstream_before,
+        "requests_per_second": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+        "p99_ms": round(percentile(latencies, 99), 1),
+    }
+
+
+def clear_caches():
+    """
+    Empty every cache in the app, as in a freshly started worker
+    """
+
+    import feeds
+    import helpers
+    import page_cache
+    import prefetch
+    import related
+    import taxonomy
+
+    feeds.cached_session.cache.clear()
+    feeds.rewritten_bodies.clear()
+    feeds.parsed_feeds.clear()
+    feeds.decoded_bodies.clear()
+    page_cache.clear()
+    helpers.format_date.cache_clear()
+    helpers.format_summary.cache_clear()
+
+    for index in [taxonomy.groups, taxonomy.categories, taxonomy.tags]:
+        index.slugs = {}
+        index.ids = {}
+        index.refreshed = 0
+
+    with related.index._lock:
+        related.index.posts = {}
+        related.index.tag_posts = {}
+        related.index.rebuilt = 0
+        related.index.synced = 0
+
+    with prefetch._lock:
+        prefetch._prefetched.clear()
+        prefetch._in_flight.clear()
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(__file__),
+            universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, baseline):
+    print(
+        "\nCompared to {} (p50 / p95 change):".format(
+            baseline.get("commit", "baseline")
+        )
+    )
+
+    for uri, phases in results["routes"].items():
+        if uri not in baseline["routes"]:
+            continue
+
+        changes = []
+
+        for phase in ["cold", "warm"]:
+            for stat in ["p50_ms", "p95_ms"]:
+                before = baseline["routes"][uri][phase][stat]
+                after = phases[phase][stat]
+                change = (after - before) / before * 100 if before else 0
+                changes.append("{:+.0f}%".format(change))
+
+        print("{:<60} cold {} / {}, warm {} / {}".format(uri[:60], *changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--requests", type=int, default=40, help="Per route, per run"
+    )
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--fixtures", help="A JSON file of fixtures")
+    parser.add_argument("--page-cache", action="store_true")
+    parser.add_argument("--output", help="Where to save the results")
+    parser.add_argument("--compare", help="Earlier results to compare with")
+    arguments = parser.parse_args()
+
+    if arguments.fixtures:
+        with open(arguments.fixtures) as fixtures_file:
+            fixtures = json.load(fixtures_file)
+    else:
+        fixtures = generate_fixtures()
+
+    server = FixtureServer(
+        fixtures,
+        latency=arguments.latency,
+        jitter=arguments.jitter,
+        error_rate=arguments.error_rate,
+    )
+    server.start()
+
+    # The app reads these settings when it's imported
+    scratch_dir = tempfile.mkdtemp()
+    os.environ["INSIGHTS_API_URL"] = server.api_url
+    os.environ["FEED_CACHE_PATH"] = os.path.join(scratch_dir, "cache.sqlite")
+    os.environ["TAXONOMY_SNAPSHOT_DIR"] = scratch_dir
+    os.environ["PAGE_CACHE"] = str(arguments.page_cache)
+
+    import app
+    from tests.tests import working_uris
+
+    # Errors are counted in the results, rather than logged
+    app.app.logger.disabled = True
+
+    results = {
+        "commit": current_commit(),
+        "date": datetime.datetime.utcnow().isoformat(),
+        "python": sys.version.split()[0],
+        "settings": {
+            name: value
+            for name, value in vars(arguments).items()
+            if name not in ["output", "compare"]
+        },
+        "routes": {},
+    }
+
+    print(
+        "{:<60} {:>6} {:>8} {:>8} {:>8} {:>9} {:>7}".format(
+            "Route", "Run", "req/s", "p50 ms", "p95 ms", "upstream", "errors"
+        )
+    )
+
+    for uri in working_uris:
+        clear_caches()
+        results["routes"][uri] = {}
+
+        for phase in ["cold", "warm"]:
+            stats = run_batch(
+                app.app,
+                server,
+                uri,
+                arguments.requests,
+                arguments.concurrency,
+            )
+            results["routes"][uri][phase] = stats
+            print(
+                "{:<60} {:>6} {:>8} {:>8} {:>8} {:>9} {:>7}".format(
+                    uri[:60],
+                    phase,
+                    stats["requests_per_second"],
+                    stats["p50_ms"],
+                    stats["p95_ms"],
+                    stats["upstream_requests"],
+                    stats["errors"],
+                )
+            )
+
+    server.stop()
+
+    output = arguments.output or os.path.join(
+        RESULTS_DIR, "routes-{}.json".format(results["commit"])
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    with open(output, "w") as output_file:
+        json.dump(results, output_file, indent=2)
+
+    print("\nSaved to {}".format(output))
+
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,500 @@
+"""
+A stand-in for the parts of the WordPress API
+(admin.insights.ubuntu.com/wp-json/wp/v2) which the app uses,
+serving fixtures with configurable latency and errors.
+
+Usage:
+
+    python3 -m benchmarks.wordpress --port 8001 --latency 0.05
+    INSIGHTS_API_URL=http://localhost:8001/wp-json/wp/v2 ./run
+
+Fixtures are generated, or can be recorded from the live API once,
+and then served offline:
+
+    python3 -m benchmarks.wordpress --record fixtures.json
+    python3 -m benchmarks.wordpress --fixtures fixtures.json
+"""
+
+# Core
+import argparse
+import datetime
+import hashlib
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+
+# Third-party
+import requests
+
+
+LIVE_API_URL = "https://admin.insights.ubuntu.com/wp-json/wp/v2"
+API_PATH = "/wp-json/wp/v2/"
+TAXONOMIES = ["group", "categories", "tags", "users", "topic"]
+
+GROUPS = [
+    "cloud-and-server",
+    "internet-of-things",
+    "desktop",
+    "canonical-announcements",
+]
+CATEGORIES = [
+    "articles",
+    "case-studies",
+    "white-papers",
+    "events",
+    "webinars",
+    "videos",
+    "news",
+]
+TAGS = ["security", "design", "juju", "maas", "snappy", "lxd", "kubernetes"]
+USERS = ["canonical", "ubuntu", "snapcraft"]
+WORDS = ["ubuntu", "snap", "kernel", "cloud", "lts", "release", "desktop"]
+# Posts the tests link to directly
+KNOWN_POSTS = [
+    ("2018-01-24", "meltdown-spectre-and-ubuntu-what-you-need-to-know"),
+    ("2017-08-31", "openstack-weekly-update-august-31-2017"),
+]
+
+
+def generate_fixtures(post_count=300, seed=0):
+    """
+    Fixtures shaped like the API's responses,
+    with enough posts to fill every listing page the app renders
+    """
+
+    generator = random.Random(seed)
+    fixtures = {
+        "group": _terms(GROUPS, 1000),
+        "categories": _terms(CATEGORIES, 2000),
+        "tags": _terms(TAGS, 3000) + [_term("snapcraft.io", 2996)],
+        "users": [
+            _user(slug, 4000 + index) for index, slug in enumerate(USERS)
+        ],
+        "topic": _terms(["maas", "juju"], 5000),
+    }
+    start = datetime.datetime(2019, 1, 1)
+    dated_slugs = [
+        (
+            (start - datetime.timedelta(hours=index * 13)).strftime(
+                "%Y-%m-%d"
+            ),
+            "post-{}".format(index),
+        )
+        for index in range(post_count - len(KNOWN_POSTS))
+    ]
+
+    fixtures["posts"] = [
+        _post(generator, fixtures, 10000 + index, date, slug)
+        for index, (date, slug) in enumerate(dated_slugs + KNOWN_POSTS)
+    ]
+    fixtures["posts"].sort(key=lambda post: post["date"], reverse=True)
+
+    return fixtures
+
+
+def record_fixtures(api_url=LIVE_API_URL, post_count=300):
+    """
+    Download every taxonomy, and the most recent posts, from the API
+    """
+
+    fixtures = {}
+
+    for endpoint in TAXONOMIES:
+        fixtures[endpoint] = _get_all(api_url, endpoint, {})
+
+    fixtures["posts"] = _get_all(
+        api_url, "posts", {"_embed": True}, limit=post_count
+    )
+
+    return fixtures
+
+
+class FixtureServer(ThreadingMixIn, HTTPServer):
+    """
+    Serve fixtures as the API would, in a background thread:
+
+        server = FixtureServer(generate_fixtures(), latency=0.05)
+        server.start()
+        requests.get(server.api_url + "/posts?per_page=3")
+        server.stop()
+
+    Each response is delayed by `latency` seconds, plus up to `jitter`,
+    and a random `error_rate` of requests fail with a 503.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self, fixtures, latency=0, jitter=0, error_rate=0, port=0, seed=0
+    ):
+        super().__init__(("127.0.0.1", port), FixtureRequestHandler)
+
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.request_count = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def api_url(self):
+        return "http://127.0.0.1:{}{}".format(
+            self.server_port, API_PATH.rstrip("/")
+        )
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def delay_and_fail(self):
+        """
+        Wait for the configured latency,
+        and return True if this request should fail
+        """
+
+        with self._lock:
+            self.request_count += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            fail = self._random.random() < self.error_rate
+
+        time.sleep(delay)
+
+        return fail
+
+
+class FixtureRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if self.server.delay_and_fail():
+            return self._send(503, {"code": "fixture_error"})
+
+        if not url.path.startswith(API_PATH):
+            return self._send(404, {"code": "rest_no_route"})
+
+        path = url.path.replace(API_PATH, "", 1)
+        endpoint, _, resource_id = path.partition("/")
+
+        if endpoint not in self.server.fixtures:
+            return self._send(404, {"code": "rest_no_route"})
+
+        resources = self.server.fixtures[endpoint]
+
+        if resource_id:
+            for resource in resources:
+                if str(resource["id"]) == resource_id:
+                    return self._send(200, _project(resource, query))
+
+            return self._send(404, {"code": "rest_term_invalid"})
+
+        if endpoint == "posts":
+            resources = _filter_posts(resources, query)
+        else:
+            posts = self.server.fixtures["posts"]
+            resources = _filter_terms(endpoint, resources, posts, query)
+
+        per_page = int(query.get("per_page", 10))
+        page = int(query.get("page", 1))
+        total_pages = math.ceil(len(resources) / per_page)
+        skipped = (page - 1) * per_page
+
+        if page > 1 and page > total_pages:
+            return self._send(400, {"code": "rest_post_invalid_page_number"})
+
+        self._send(
+            200,
+            [
+                _project(resource, query)
+                for resource in resources[skipped:][:per_page]
+            ],
+            {
+                "X-WP-Total": str(len(resources)),
+                "X-WP-TotalPages": str(total_pages),
+            },
+        )
+
+    def _send(self, status, data, headers={}):
+        body = json.dumps(data).encode("utf-8")
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            status = 304
+            body = b""
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _project(resource, query):
+    """
+    Keep only the `_fields` and `_embed`ded resources asked for
+    """
+
+    embeds = query.get("_embed", "")
+
+    if "_embedded" in resource and embeds.lower() not in ["", "1", "true"]:
+        resource = dict(
+            resource,
+            _embedded={
+                name: embedded
+                for name, embedded in resource["_embedded"].items()
+                if name in embeds.split(",")
+            },
+        )
+
+    if query.get("_fields"):
+        fields = query["_fields"].split(",")
+        resource = {
+            name: value for name, value in resource.items() if name in fields
+        }
+
+    return resource
+
+
+def _filter_posts(posts, query):
+    def ids(name):
+        return {
+            int(value) for value in query.get(name, "").split(",") if value
+        }
+
+    slugs = set(filter(None, query.get("slug", "").split(",")))
+    groups = ids("group")
+    categories = ids("categories")
+    tags = ids("tags")
+    tags_exclude = ids("tags_exclude")
+    authors = ids("author")
+    search = query.get("search", "").lower()
+
+    def matches(post):
+        return (
+            (not slugs or post["slug"] in slugs)
+            and (not groups or groups.intersection(post["group"]))
+            and (not categories or categories.intersection(post["categories"]))
+            and (not tags or tags.intersection(post["tags"]))
+            and not tags_exclude.intersection(post["tags"])
+            and (not authors or post["author"] in authors)
+            and (
+                "sticky" not in query or str(post["sticky"]) == query["sticky"]
+            )
+            and (not search or search in post["title"]["rendered"].lower())
+            and post["date"] < query.get("before", "9999")
+            and post["date"] > query.get("after", "0000")
+            and str(post["id"]) != query.get("exclude")
+        )
+
+    posts = [post for post in posts if matches(post)]
+
+    if query.get("orderby") == "modified":
+        posts.sort(key=lambda post: post["modified"], reverse=True)
+
+    return posts
+
+
+def _filter_terms(endpoint, terms, posts, query):
+    slugs = set(filter(None, query.get("slug", "").split(",")))
+    ids = {
+        int(value) for value in query.get("include", "").split(",") if value
+    }
+
+    if "post" in query:
+        post_terms = set()
+
+        for post in posts:
+            if str(post["id"]) == query["post"]:
+                post_terms.update(post.get(endpoint, []))
+
+        terms = [term for term in terms if term["id"] in post_terms]
+
+    return [
+        term
+        for term in terms
+        if (not slugs or term["slug"] in slugs)
+        and (not ids or term["id"] in ids)
+    ]
+
+
+def _term(slug, term_id):
+    return {
+        "id": term_id,
+        "slug": slug,
+        "name": slug.replace("-", " ").title(),
+        "description": "All about {}".format(slug),
+        "count": 10,
+        "url": "https://www.ubuntu.com/{}".format(slug),
+        "hero_url": "https://assets.ubuntu.com/v1/hero.jpg",
+        "logo_url": "https://assets.ubuntu.com/v1/logo.svg",
+        "subtitle": "",
+        "strip_css": "",
+    }
+
+
+def _terms(slugs, first_id):
+    return [_term(slug, first_id + index) for index, slug in enumerate(slugs)]
+
+
+def _user(slug, user_id):
+    return {
+        "id": user_id,
+        "slug": slug,
+        "name": slug.title(),
+        "link": "https://admin.insights.ubuntu.com/author/{}/".format(slug),
+        "description": "",
+        "avatar_urls": {
+            size: "https://secure.gravatar.com/avatar/{}?s={}".format(
+                slug, size
+            )
+            for size in ["24", "48", "96"]
+        },
+        "user_photo": "",
+        "user_job_title": "",
+        "user_twitter": "",
+        "user_facebook": "",
+        "user_google": "",
+    }
+
+
+def _post(generator, fixtures, post_id, date, slug):
+    def pick(terms, count=1):
+        return [term["id"] for term in generator.sample(terms, count)]
+
+    def words(count):
+        return " ".join(generator.choice(WORDS) for _ in range(count))
+
+    author = generator.choice(fixtures["users"])
+    categories = pick(fixtures["categories"])
+    paragraphs = ["<p>{}</p>".format(words(60)) for _ in range(20)]
+    paragraphs.insert(
+        3,
+        '<p><img class="aligncenter" src="https://assets.ubuntu.com/v1/'
+        '{}.png" alt="" width="720" height="405" /></p>'.format(post_id),
+    )
+    event = fixtures["categories"][CATEGORIES.index("events")]["id"]
+    time_of_day = "T{:02d}:00:00".format(post_id % 24)
+
+    return {
+        "id": post_id,
+        "date": date + time_of_day,
+        "date_gmt": date + time_of_day,
+        "modified": date + time_of_day,
+        "slug": slug,
+        "link": "https://admin.insights.ubuntu.com/{}/{}/".format(
+            date.replace("-", "/"), slug
+        ),
+        "guid": {
+            "rendered": "https://admin.insights.ubuntu.com/?p={}".format(
+                post_id
+            )
+        },
+        "title": {"rendered": words(6).capitalize()},
+        "excerpt": {"rendered": "<p>{} [&hellip;]</p>\n".format(words(60))},
+        "content": {"rendered": "\n".join(paragraphs)},
+        "author": author["id"],
+        "sticky": post_id % 20 == 0,
+        "group": pick(fixtures["group"]),
+        "categories": categories,
+        "tags": pick(fixtures["tags"], 2),
+        "topic": pick(fixtures["topic"]),
+        "_start_day": "1" if event in categories else "",
+        "_start_month": "6" if event in categories else "",
+        "_start_year": "2019" if event in categories else "",
+        "_end_day": "",
+        "_end_month": "",
+        "_end_year": "",
+        "_event_venue": "",
+        "_event_location": "",
+        "_embedded": {
+            "author": [author],
+            "wp:featuredmedia": [
+                {
+                    "id": post_id,
+                    "source_url": "https://assets.ubuntu.com/v1/{}.jpg".format(
+                        post_id
+                    ),
+                    "alt_text": "",
+                }
+            ],
+        },
+    }
+
+
+def _get_all(api_url, endpoint, parameters, limit=None):
+    resources = []
+    page = 1
+
+    while limit is None or len(resources) < limit:
+        response = requests.get(
+            "{}/{}".format(api_url, endpoint),
+            params=dict(parameters, per_page=100, page=page),
+            timeout=30,
+        )
+        response.raise_for_status()
+        resources += response.json()
+
+        if page >= int(response.headers.get("X-WP-TotalPages", 1)):
+            break
+
+        page += 1
+
+    return resources[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--jitter", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--fixtures", help="A JSON file of fixtures to serve")
+    parser.add_argument(
+        "--record", help="Save fixtures from the live API to this file"
+    )
+    arguments = parser.parse_args()
+
+    if arguments.record:
+        with open(arguments.record, "w") as fixtures_file:
+            json.dump(record_fixtures(), fixtures_file)
+
+        return
+
+    if arguments.fixtures:
+        with open(arguments.fixtures) as fixtures_file:
+            fixtures = json.load(fixtures_file)
+    else:
+        fixtures = generate_fixtures()
+
+    server = FixtureServer(
+        fixtures,
+        latency=arguments.latency,
+        jitter=arguments.jitter,
+        error_rate=arguments.error_rate,
+        port=arguments.port,
+    )
+    print("Serving {}".format(server.api_url))
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
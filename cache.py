@@ -0,0 +1,476 @@
+# Core
+import datetime
+import os
+import pickle
+import sqlite3
+import stat
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+# Third-party
+import prometheus_client
+from requests_cache.backends.base import BaseCache
+
+
+# Prometheus metric exporters
+cache_entries = prometheus_client.Gauge(
+    "feed_cache_entries", "The number of cached responses", ["domain"]
+)
+cache_bytes = prometheus_client.Gauge(
+    "feed_cache_bytes", "The size of cached responses", ["domain"]
+)
+cache_evictions = prometheus_client.Counter(
+    "feed_cache_evictions",
+    "A counter of responses evicted to keep the cache within its budget",
+    ["domain"],
+)
+
+# Only record a new access time for an entry once per minute,
+# to avoid a write for every cache hit
+ACCESS_RESOLUTION_SECONDS = 60
+
+# Bump this to discard existing caches when the schema changes
+SQLITE_SCHEMA_VERSION = 3
+
+# The domains currently reported by the size gauges
+_gauge_domains = set()
+
+
+class MemoryCache(BaseCache):
+    """
+    An in-memory cache backend which keeps at most `max_entries` responses,
+    of at most `max_bytes` in total, by evicting the least recently used.
+    Responses from the cache have their creation time as `created_at`.
+
+    It is safe to use while other threads (see fanout.py)
+    are adding new responses.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, **options):
+        super().__init__(**options)
+
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.responses = OrderedDict()
+        # key -> (domain, size) for each response
+        self.sizes = {}
+        self.total_bytes = 0
+        self._lock = threading.RLock()
+
+    def save_response(self, key, response):
+        with self._lock:
+            self.delete(key)
+            super().save_response(key, response)
+
+            size = len(response.content or b"")
+            self.sizes[key] = (_domain(response), size)
+            self.total_bytes += size
+
+            self._evict_least_recently_used()
+
+    def get_response_and_time(self, key, default=(None, None)):
+        with self._lock:
+            key = key if key in self.responses else self.keys_map.get(key)
+
+            if key not in self.responses:
+                return default
+
+            self.responses.move_to_end(key)
+            response, created = super().get_response_and_time(key, default)
+            response.created_at = created
+
+            return response, created
+
+    def delete(self, key):
+        with self._lock:
+            key = key if key in self.responses else self.keys_map.get(key)
+            domain, size = self.sizes.pop(key, (None, 0))
+            self.total_bytes -= size
+
+            super().delete(key)
+
+    def remove_old_entries(self, created_before):
+        """
+        Delete all expired entries, then evict the least recently used
+        entries until the cache is within budget
+        """
+
+        with self._lock:
+            for key, (response, created_at) in list(self.responses.items()):
+                if created_at < created_before:
+                    self.delete(key)
+
+            self._evict_least_recently_used()
+
+        self.update_metrics()
+
+    def update_metrics(self):
+        stats = {}
+
+        with self._lock:
+            for domain, size in self.sizes.values():
+                entries, total = stats.get(domain, (0, 0))
+                stats[domain] = (entries + 1, total + size)
+
+        _set_size_gauges(stats)
+
+    def _evict_least_recently_used(self):
+        while self.responses and (
+            (self.max_entries and len(self.responses) > self.max_entries)
+            or (self.max_bytes and self.total_bytes > self.max_bytes)
+        ):
+            key = next(iter(self.responses))
+            domain, _ = self.sizes.get(key, ("", 0))
+            self.delete(key)
+            cache_evictions.labels(domain=domain).inc()
+
+
+class SQLiteCache(BaseCache):
+    """
+    A requests_cache backend which keeps responses in a SQLite database
+    in WAL mode, so every worker process on a node can read and write
+    a single shared copy of each response:
+
+        cached_session = requests_cache.CachedSession(
+            backend=SQLiteCache("/tmp/cache.sqlite", timedelta(hours=1)),
+            expire_after=timedelta(hours=1),
+        )
+
+    Each entry stores its own expiry time, and every write
+    is a single statement, so readers never see a partial entry.
+    Responses from the cache have their creation time as `created_at`.
+
+    As responses are unpickled, the database is created readable only by
+    the current user, and a database owned by anyone else is refused.
+
+    Whenever `remove_old_entries` runs, the least recently used entries
+    are evicted to bring the cache within `max_entries` and `max_bytes`.
+    """
+
+    def __init__(
+        self, path, expire_after, max_entries=None, max_bytes=None, **options
+    ):
+        super().__init__(**options)
+
+        self.path = path
+        self.expire_after = expire_after
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+
+        _create_private_file(path)
+
+        connection = self._connection()
+        version = connection.execute("PRAGMA user_version").fetchone()[0]
+
+        if version != SQLITE_SCHEMA_VERSION:
+            connection.execute("DROP TABLE IF EXISTS responses")
+            connection.execute("DROP TABLE IF EXISTS urls")
+            connection.execute("DROP TABLE IF EXISTS leases")
+            connection.execute(
+                "PRAGMA user_version = {}".format(SQLITE_SCHEMA_VERSION)
+            )
+
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, response BLOB, expires REAL, "
+            "domain TEXT, size INTEGER, accessed REAL)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_expires "
+            "ON responses (expires)"
+        )
+        connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed "
+            "ON responses (accessed)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS urls "
+            "(key TEXT PRIMARY KEY, response_key TEXT)"
+        )
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS leases "
+            "(key TEXT PRIMARY KEY, expires REAL)"
+        )
+
+    def _connection(self):
+        """
+        SQLite connections can't be shared between threads,
+        or survive a fork, so open one per thread per process
+        """
+
+        pid = os.getpid()
+
+        if getattr(self._local, "pid", None) != pid:
+            connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+
+            self._local.connection = connection
+            self._local.pid = pid
+
+        return self._local.connection
+
+    def save_response(self, key, response, expire_after=None):
+        now = time.time()
+        expires = now + (expire_after or self.expire_after).total_seconds()
+        data = pickle.dumps(self.reduce_response(response))
+
+        self._connection().execute(
+            "INSERT OR REPLACE INTO responses "
+            "(key, response, expires, domain, size, accessed) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                sqlite3.Binary(data),
+                expires,
+                _domain(response),
+                len(data),
+                now,
+            ),
+        )
+
+    def add_key_mapping(self, new_key, key_to_response):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO urls (key, response_key) VALUES (?, ?)",
+            (new_key, key_to_response),
+        )
+
+    def get_response_and_time(self, key, default=(None, None)):
+        """
+        Retrieve the response for `key`, along with the time it was
+        created - adjusted so that `CachedSession` will consider it
+        expired at the time stored with the entry
+        """
+
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT key, response, expires, accessed FROM responses "
+            "WHERE key = ? "
+            "OR key = (SELECT response_key FROM urls WHERE key = ?)",
+            (key, key),
+        ).fetchone()
+
+        if not row:
+            return default
+
+        key, response, expires, accessed = row
+        now = time.time()
+
+        if accessed < now - ACCESS_RESOLUTION_SECONDS:
+            connection.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+            )
+
+        created = (
+            datetime.datetime.utcfromtimestamp(expires) - self.expire_after
+        )
+        response = self.restore_response(pickle.loads(bytes(response)))
+        response.created_at = created
+
+        return response, created
+
+    def delete(self, key):
+        connection = self._connection()
+        connection.execute(
+            "DELETE FROM responses WHERE key = ? "
+            "OR key = (SELECT response_key FROM urls WHERE key = ?)",
+            (key, key),
+        )
+        connection.execute(
+            "DELETE FROM urls WHERE key = ? OR response_key = ?", (key, key)
+        )
+
+    def clear(self):
+        connection = self._connection()
+        connection.execute("DELETE FROM responses")
+        connection.execute("DELETE FROM urls")
+
+    def remove_old_entries(self, created_before):
+        """
+        Delete all expired entries, then evict the least recently used
+        entries until the cache is within budget.
+
+        As entries store their expiry time rather than their creation time,
+        "created before `created_before`" means "expires before
+        `created_before + expire_after`"
+        """
+
+        created_before = created_before.replace(
+            tzinfo=datetime.timezone.utc
+        ).timestamp()
+        expired_before = created_before + self.expire_after.total_seconds()
+
+        connection = self._connection()
+        connection.execute(
+            "DELETE FROM responses WHERE expires < ?", (expired_before,)
+        )
+        self._evict_least_recently_used()
+        connection.execute(
+            "DELETE FROM urls WHERE response_key NOT IN "
+            "(SELECT key FROM responses)"
+        )
+
+        self.update_metrics()
+
+    def update_metrics(self):
+        rows = self._connection().execute(
+            "SELECT domain, COUNT(*), TOTAL(size) FROM responses "
+            "GROUP BY domain"
+        )
+
+        _set_size_gauges(
+            {domain: (entries, size) for domain, entries, size in rows}
+        )
+
+    def _evict_least_recently_used(self):
+        connection = self._connection()
+        entries, total_bytes = connection.execute(
+            "SELECT COUNT(*), TOTAL(size) FROM responses"
+        ).fetchone()
+
+        excess_entries = entries - (self.max_entries or entries)
+        excess_bytes = total_bytes - (self.max_bytes or total_bytes)
+
+        if excess_entries <= 0 and excess_bytes <= 0:
+            return
+
+        evicted = []
+        rows = connection.execute(
+            "SELECT key, domain, size FROM responses ORDER BY accessed"
+        ).fetchall()
+
+        for key, domain, size in rows:
+            if excess_entries <= 0 and excess_bytes <= 0:
+                break
+
+            evicted.append((key, domain))
+            excess_entries -= 1
+            excess_bytes -= size
+
+        connection.executemany(
+            "DELETE FROM responses WHERE key = ?",
+            [(key,) for key, domain in evicted],
+        )
+
+        for key, domain in evicted:
+            cache_evictions.labels(domain=domain).inc()
+
+    def has_key(self, key):
+        return self.get_response_and_time(key)[0] is not None
+
+    def acquire_lease(self, key, seconds):
+        """
+        Try to take out a lease on `key`, to tell other workers that
+        a response for it is being fetched. Leases lapse after `seconds`,
+        in case their holder dies.
+
+        Returns `True` if the lease was acquired.
+        """
+
+        now = time.time()
+        connection = self._connection()
+        connection.execute(
+            "DELETE FROM leases WHERE key = ? AND expires < ?", (key, now)
+        )
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO leases (key, expires) VALUES (?, ?)",
+            (key, now + seconds),
+        )
+
+        return cursor.rowcount == 1
+
+    def release_lease(self, key):
+        self._connection().execute("DELETE FROM leases WHERE key = ?", (key,))
+
+    def has_lease(self, key):
+        row = (
+            self._connection()
+            .execute(
+                "SELECT 1 FROM leases WHERE key = ? AND expires >= ?",
+                (key, time.time()),
+            )
+            .fetchone()
+        )
+
+        return row is not None
+
+
+def private_directory(name):
+    """
+    A directory in the system's temporary directory for the current
+    user only, e.g. "/tmp/insights-cache-1000" for "insights-cache".
+    Raises PermissionError if anyone else owns it or can write to it.
+    """
+
+    path = os.path.join(
+        tempfile.gettempdir(), "{}-{}".format(name, os.getuid())
+    )
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    status = os.lstat(path)
+
+    if (
+        not stat.S_ISDIR(status.st_mode)
+        or status.st_uid != os.getuid()
+        or status.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    ):
+        raise PermissionError("{} isn't a private directory".format(path))
+
+    return path
+
+
+def open_private_file(path, flags):
+    """
+    Open a file descriptor without following symlinks. With os.O_CREAT,
+    a new file is readable and writable only by the current user.
+    Raises PermissionError if anyone else owns the file.
+    """
+
+    descriptor = os.open(path, flags | os.O_NOFOLLOW, 0o600)
+
+    try:
+        if os.fstat(descriptor).st_uid != os.getuid():
+            raise PermissionError("{} is owned by another user".format(path))
+    except Exception as owner_error:
+        os.close(descriptor)
+        raise owner_error
+
+    return descriptor
+
+
+def _create_private_file(path):
+    """
+    Create a file readable and writable only by the current user,
+    unless it exists. Raises PermissionError if anyone else owns it.
+    """
+
+    os.close(open_private_file(path, os.O_RDWR | os.O_CREAT))
+
+
+def _domain(response):
+    return urlparse(response.url or "").netloc
+
+
+def _set_size_gauges(stats):
+    """
+    Given {domain: (entries, bytes)}, update the size gauges,
+    resetting any domains which are no longer in the cache
+    """
+
+    global _gauge_domains
+
+    for domain in _gauge_domains.difference(stats):
+        stats[domain] = (0, 0)
+
+    for domain, (entries, size) in stats.items():
+        cache_entries.labels(domain=domain).set(entries)
+        cache_bytes.labels(domain=domain).set(size)
+
+    _gauge_domains = {
+        domain for domain, (entries, _) in stats.items() if entries
+    }
@@ -1,17 +1,30 @@
 # Core
+import copy
+import os
+import tempfile
 import time
 import datetime
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from urllib.parse import urlparse
 
 # Third-party
 import feedparser
 import logging
+import requests
 import requests_cache
 import prometheus_client
 from requests.packages.urllib3.util.retry import Retry
 from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
 
+# Local
+import timing
+from cache import MemoryCache, SQLiteCache, private_directory
+from transport import RecordingAdapter, ReplayAdapter, ResponseArchive
+
 
 # Prometheus metric exporters
 requested_from_cache_counter = prometheus_client.Counter(
@@ -30,12 +43,71 @@ request_latency_seconds = prometheus_client.Histogram(
     ["domain", "code"],
     buckets=[0.25, 0.5, 0.75, 1, 2],
 )
+cache_lookups = prometheus_client.Counter(
+    "feed_cache_lookups",
+    "A counter of cache lookups, by whether they were served from the cache",
+    ["domain", "backend", "result"],
+)
+stale_responses = prometheus_client.Counter(
+    "feed_stale_responses",
+    "A counter of expired responses served while refreshing in the background",
+    ["domain"],
+)
+background_refreshes = prometheus_client.Counter(
+    "feed_background_refreshes",
+    "A counter of background cache refreshes, by outcome",
+    ["domain", "outcome"],
+)
+revalidations = prometheus_client.Counter(
+    "feed_revalidations",
+    "A counter of conditional requests for expired responses, by result",
+    ["domain", "result"],
+)
+revalidation_bytes_saved = prometheus_client.Counter(
+    "feed_revalidation_bytes_saved",
+    "The size of response bodies not downloaded again thanks to a 304",
+    ["domain"],
+)
+coalesced_requests = prometheus_client.Counter(
+    "feed_coalesced_requests",
+    "A counter of requests which waited for an identical in-flight request",
+    ["domain", "scope"],
+)
 
 # Cache session settings
+# By default, share one SQLite cache between all workers on the node,
+# at FEED_CACHE_PATH, or in a temporary directory only this user can use.
+# Set FEED_CACHE_BACKEND=memory to keep a separate cache in each worker.
+# Either way, the cache keeps within FEED_CACHE_MAX_ENTRIES responses
+# and FEED_CACHE_MAX_BYTES (256MB by default), and is swept every
+# FEED_CACHE_SWEEP_SECONDS.
+cache_expire_after = datetime.timedelta(hours=1)
+cache_backend_name = os.environ.get("FEED_CACHE_BACKEND", "sqlite")
+cache_max_entries = int(os.environ.get("FEED_CACHE_MAX_ENTRIES", 5000))
+cache_max_bytes = int(os.environ.get("FEED_CACHE_MAX_BYTES", 268435456))
+cache_sweep_interval = int(os.environ.get("FEED_CACHE_SWEEP_SECONDS", 60))
+cache_last_swept = time.time()
+cache_sweep_lock = threading.Lock()
+
+if cache_backend_name == "memory":
+    cache_backend = MemoryCache(
+        max_entries=cache_max_entries, max_bytes=cache_max_bytes
+    )
+else:
+    cache_backend = SQLiteCache(
+        path=os.environ.get("FEED_CACHE_PATH")
+        or os.path.join(
+            private_directory("insights-cache"), "insights-hour-cache.sqlite"
+        ),
+        expire_after=cache_expire_after,
+        max_entries=cache_max_entries,
+        max_bytes=cache_max_bytes,
+    )
+
 cached_session = requests_cache.CachedSession(
     name="hour-cache",
-    expire_after=datetime.timedelta(hours=1),
-    backend="memory",
+    expire_after=cache_expire_after,
+    backend=cache_backend,
     old_data_on_error=True,
 )
 cached_session.mount(
@@ -43,10 +115,94 @@ cached_session.mount(
     HTTPAdapter(
         max_retries=Retry(
             total=5, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504]
-        )
+        ),
+        # Keep enough connections alive for every thread making requests
+        # (see fanout.py and async_api.py)
+        pool_maxsize=int(os.environ.get("FEED_POOL_SIZE", 32)),
     ),
 )
 
+# Transport settings
+# Set FEED_TRANSPORT=record to save every upstream response to the
+# FEED_ARCHIVE_PATH archive, or FEED_TRANSPORT=replay to answer every
+# request from that archive instead of the network, e.g. to run the tests
+# offline. Replay with FEED_CACHE_BACKEND=memory to skip the shared cache.
+transport_mode = os.environ.get("FEED_TRANSPORT", "live")
+
+if transport_mode in ["record", "replay"]:
+    archive = ResponseArchive(
+        os.environ.get(
+            "FEED_ARCHIVE_PATH",
+            os.path.join(tempfile.gettempdir(), "insights-archive.jsonl.gz"),
+        )
+    )
+
+    for prefix in ["https://", "http://"]:
+        if transport_mode == "record":
+            adapter = RecordingAdapter(
+                cached_session.get_adapter(prefix), archive
+            )
+        else:
+            adapter = ReplayAdapter(archive)
+
+        cached_session.mount(prefix, adapter)
+
+# Stale-while-revalidate settings
+# For FEED_CACHE_STALE_SECONDS after a response expires, keep serving it
+# while refreshing it in the background, with at most
+# FEED_CACHE_MAX_REFRESHES refreshes running at once
+cache_stale_window = datetime.timedelta(
+    seconds=int(os.environ.get("FEED_CACHE_STALE_SECONDS", 600))
+)
+max_background_refreshes = int(os.environ.get("FEED_CACHE_MAX_REFRESHES", 4))
+refresh_executor = ThreadPoolExecutor(max_workers=max_background_refreshes)
+refreshing_keys = set()
+refreshing_keys_lock = threading.Lock()
+
+# Request coalescing settings
+# Concurrent requests for the same URL in a worker share one upstream call.
+# With the SQLite cache, set FEED_COALESCE_ACROSS_WORKERS=true to also
+# wait on identical requests from other workers on the node, for up to
+# FEED_COALESCE_WAIT_SECONDS.
+in_flight_requests = {}
+in_flight_requests_lock = threading.Lock()
+coalesce_across_workers = isinstance(cache_backend, SQLiteCache) and (
+    os.environ.get("FEED_COALESCE_ACROSS_WORKERS", "").lower() in ["true", "1"]
+)
+coalesce_wait_seconds = int(os.environ.get("FEED_COALESCE_WAIT_SECONDS", 5))
+
+# The headers a 304 updates on the cached response it confirms
+REVALIDATED_HEADERS = [
+    "Cache-Control",
+    "Date",
+    "ETag",
+    "Expires",
+    "Last-Modified",
+]
+
+# Rewritten feed settings
+# Stream rewritten response bodies in FEED_CHUNK_BYTES chunks,
+# keeping the last FEED_REWRITTEN_ENTRIES to serve whole
+rewrite_chunk_bytes = int(os.environ.get("FEED_CHUNK_BYTES", 16384))
+rewritten_max_entries = int(os.environ.get("FEED_REWRITTEN_ENTRIES", 100))
+# (url, validator) -> rewritten body, least recently used first
+rewritten_bodies = OrderedDict()
+rewritten_bodies_lock = threading.Lock()
+
+# Parsed feed settings
+# Keep the parsed entries of the last FEED_PARSED_ENTRIES feed responses
+parsed_max_entries = int(os.environ.get("FEED_PARSED_ENTRIES", 50))
+# (url, ETag or body hash) -> entries, least recently used first
+parsed_feeds = OrderedDict()
+parsed_feeds_lock = threading.Lock()
+
+# Decoded JSON settings
+# Keep the decoded bodies of the last FEED_DECODED_ENTRIES JSON responses
+decoded_max_entries = int(os.environ.get("FEED_DECODED_ENTRIES", 200))
+# (url, ETag or body hash, prepare) -> decoded data, least recently used first
+decoded_bodies = OrderedDict()
+decoded_bodies_lock = threading.Lock()
+
 
 def get_rss_feed_content(url, offset=0, limit=6, exclude_items_in=None):
     """
@@ -67,41 +223,118 @@ def get_rss_feed_content(url, offset=0, limit=6, exclude_items_in=None):
         )
         return False
 
-    try:
-        feed_data = feedparser.parse(response.text)
-        if not feed_data.feed:
+    key = (
+        url,
+        response.headers.get("ETag")
+        or hashlib.sha1(response.content).hexdigest(),
+    )
+    content = _get_kept(parsed_feeds, parsed_feeds_lock, key)
+
+    if content is None:
+        try:
+            content = _parse_feed(response)
+        except Exception as parse_error:
+            logger.warning(
+                "Failed to parse feed from {}: {}".format(
+                    url, str(parse_error)
+                )
+            )
+            return False
+
+        if content is None:
             logger.warning("No valid feed data found at {}".format(url))
             return False
-        content = feed_data.entries
-    except Exception as parse_error:
-        logger.warning(
-            "Failed to parse feed from {}: {}".format(url, str(parse_error))
+
+        _keep(
+            parsed_feeds, parsed_feeds_lock, key, content, parsed_max_entries
         )
-        return False
 
     if exclude_items_in:
-        exclude_ids = [item["guid"] for item in exclude_items_in]
+        exclude_ids = {item["guid"] for item in exclude_items_in}
         content = [item for item in content if item["guid"] not in exclude_ids]
 
-    content = content[offset:end]
+    return content[offset:end]
+
+
+def decoded_json(response, prepare=None):
+    """
+    Decode the JSON body of a response, keeping the result for as long as
+    the body stays the same, so cache hits don't decode it again.
+    `prepare` is applied once to newly decoded data, before it's kept.
+
+    The list or object returned, and the items directly in a list,
+    are copies which the caller can change. Anything nested deeper is
+    shared with other requests, so must be replaced, not changed.
+    """
+
+    key = (
+        response.url,
+        response.headers.get("ETag")
+        or hashlib.sha1(response.content).hexdigest(),
+        prepare,
+    )
+    data = _get_kept(decoded_bodies, decoded_bodies_lock, key)
+
+    if data is None:
+        data = response.json()
 
-    for item in content:
-        updated_time = time.mktime(item["updated_parsed"])
-        item["updated_datetime"] = datetime.datetime.fromtimestamp(
-            updated_time
+        if prepare:
+            data = prepare(data)
+
+        _keep(
+            decoded_bodies,
+            decoded_bodies_lock,
+            key,
+            data,
+            decoded_max_entries,
         )
 
-    return content
+    if isinstance(data, list):
+        return [copy.copy(item) for item in data]
+
+    return copy.copy(data)
+
+
+def _parse_feed(response):
+    """
+    Parse the entries from a feed response, adding an `updated_datetime`
+    to each, or return None if it isn't a feed
+    """
+
+    feed_data = feedparser.parse(response.text)
+
+    if not feed_data.feed:
+        return None
+
+    for item in feed_data.entries:
+        if item.get("updated_parsed"):
+            updated_time = time.mktime(item["updated_parsed"])
+            item["updated_datetime"] = datetime.datetime.fromtimestamp(
+                updated_time
+            )
+
+    return feed_data.entries
 
 
 def cached_request(url):
     """
     Retrieve the response from the requests cache.
-    If the cache has expired then it will attempt to update the cache.
+    If the cache has expired, but only within the stale window,
+    it will return the expired response and update the cache in
+    the background. Otherwise it will attempt to update the cache.
     If it gets an error, it will use the cached response, if it exists.
     """
 
-    response = cached_session.get(url, timeout=3)
+    started = time.time()
+    response = _get_cached_response(url)
+
+    if response is None:
+        response = _coalesced_get(url)
+
+    from_cache = getattr(response, "from_cache", False)
+    timing.record_upstream_call(
+        time.time() - started, from_cache, _expires(response)
+    )
 
     try:
         response.raise_for_status()
@@ -112,13 +345,424 @@ def cached_request(url):
         ).inc()
         raise request_error
 
-    if hasattr(response, "from_cache") and response.from_cache:
+    cache_lookups.labels(
+        domain=urlparse(url).netloc,
+        backend=cache_backend_name,
+        result="hit" if from_cache else "miss",
+    ).inc()
+
+    if from_cache:
         requested_from_cache_counter.labels(domain=urlparse(url).netloc).inc()
     else:
         request_latency_seconds.labels(
             domain=urlparse(url).netloc, code=response.status_code
         ).observe(response.elapsed.total_seconds())
 
-    cached_session.remove_expired_responses()
+    _sweep_cache()
+
+    return response
+
+
+def fresh_request(url):
+    """
+    Request a URL from upstream even if it's in the cache, for background
+    syncs which need changes sooner than the cache expires,
+    and cache the response for everything else
+    """
+
+    request = cached_session.prepare_request(requests.Request("GET", url))
+    response = _send_uncached(request)
+    response.raise_for_status()
+
+    if response.status_code == 200:
+        cached_session.cache.save_response(_cache_key(url), response)
+
+    response.from_cache = False
+
+    return response
+
+
+def stream_rewritten(url, old, new):
+    """
+    Request a URL through the cache, and stream its body back
+    in chunks with every occurrence of `old` replaced with `new`
+    (both bytes). E.g.:
+
+        flask.Response(
+            stream_rewritten(url, b"admin.example.com", b"example.com")
+        )
+
+    The rewritten body is kept for as long as the cached response,
+    so later requests get it in one piece without rewriting it again.
+    """
+
+    response = cached_request(url)
+    chunks = _replace_in_chunks(
+        response.iter_content(rewrite_chunk_bytes), old, new
+    )
+    validator = (
+        response.headers.get("ETag")
+        or response.headers.get("Last-Modified")
+        or response.headers.get("Date")
+    )
+
+    if not validator:
+        # No way to tell when the response changes, so never keep it
+        return chunks
+
+    key = (url, old, new, validator)
+    body = _get_kept(rewritten_bodies, rewritten_bodies_lock, key)
+
+    if body is not None:
+        return iter([body])
+
+    return _stream_and_keep(key, chunks)
+
+
+def _replace_in_chunks(chunks, old, new):
+    """
+    Replace `old` with `new` in a stream of chunks,
+    holding back the end of each chunk in case it starts an `old`
+    which finishes in the next chunk
+    """
+
+    carried = b""
+
+    for chunk in chunks:
+        buffer = carried + chunk
+        # Any match starting before here ends within the buffer
+        complete_before = len(buffer) - len(old) + 1
+        output = []
+        position = 0
+
+        while True:
+            match = buffer.find(old, position)
+
+            if match == -1 or match >= complete_before:
+                break
+
+            output.append(buffer[position:match])
+            output.append(new)
+            position = match + len(old)
+
+        keep_from = max(position, complete_before)
+        output.append(buffer[position:keep_from])
+        carried = buffer[keep_from:]
+
+        yield b"".join(output)
+
+    if carried:
+        yield carried
+
+
+def _stream_and_keep(key, chunks):
+    """
+    Yield the chunks, then save the whole body under `key`
+    """
+
+    body = []
+
+    for chunk in chunks:
+        body.append(chunk)
+        yield chunk
+
+    _keep(
+        rewritten_bodies,
+        rewritten_bodies_lock,
+        key,
+        b"".join(body),
+        rewritten_max_entries,
+    )
+
+
+def _get_kept(kept, lock, key):
+    """
+    Get a value from a least-recently-used OrderedDict
+    """
+
+    with lock:
+        value = kept.get(key)
+
+        if value is not None:
+            kept.move_to_end(key)
+
+        return value
+
+
+def _keep(kept, lock, key, value, max_entries):
+    """
+    Add a value to a least-recently-used OrderedDict,
+    evicting the oldest values beyond `max_entries`
+    """
+
+    with lock:
+        kept[key] = value
+        kept.move_to_end(key)
+
+        while len(kept) > max_entries:
+            kept.popitem(last=False)
+
+
+def _sweep_cache():
+    """
+    At most once every sweep interval, remove responses which have left
+    the stale window, and evict responses to keep the cache within budget
+    """
+
+    global cache_last_swept
+
+    if time.time() - cache_last_swept < cache_sweep_interval:
+        return
+
+    if not cache_sweep_lock.acquire(blocking=False):
+        # Another thread is already sweeping
+        return
+
+    try:
+        cache_last_swept = time.time()
+        cached_session.cache.remove_old_entries(
+            datetime.datetime.utcnow()
+            - cache_expire_after
+            - cache_stale_window
+        )
+    finally:
+        cache_sweep_lock.release()
+
+
+def _get_cached_response(url):
+    """
+    Return the cached response for this URL if it hasn't expired.
+    If it has expired within the stale window, schedule a background refresh
+    and return the expired response. Otherwise return None.
+    """
+
+    key = _cache_key(url)
+    response, created = cached_session.cache.get_response_and_time(key)
+
+    if response is None:
+        return None
+
+    age = datetime.datetime.utcnow() - created
+
+    if age > cache_expire_after + cache_stale_window:
+        return None
+
+    if age > cache_expire_after:
+        domain = urlparse(url).netloc
+
+        with refreshing_keys_lock:
+            if key in refreshing_keys:
+                pass
+            elif len(refreshing_keys) >= max_background_refreshes:
+                background_refreshes.labels(
+                    domain=domain, outcome="skipped"
+                ).inc()
+            else:
+                refreshing_keys.add(key)
+                refresh_executor.submit(_refresh, url, key)
+
+        stale_responses.labels(domain=domain).inc()
+
+    response.from_cache = True
 
     return response
+
+
+def _refresh(url, key):
+    """
+    Update the cache for an expired response
+    """
+
+    domain = urlparse(url).netloc
+
+    try:
+        response = _coalesced_get(url)
+
+        revalidated = getattr(response, "revalidated", False)
+
+        if (response.from_cache and not revalidated) or not response.ok:
+            outcome = "failed"
+        else:
+            outcome = "succeeded"
+    except Exception:
+        outcome = "failed"
+    finally:
+        with refreshing_keys_lock:
+            refreshing_keys.discard(key)
+
+    background_refreshes.labels(domain=domain, outcome=outcome).inc()
+
+
+def _expires(response):
+    """
+    When a response expires from the cache, as a timestamp
+    """
+
+    created = getattr(response, "created_at", None)
+
+    if not getattr(response, "from_cache", False) or created is None:
+        # Just requested
+        return time.time() + cache_expire_after.total_seconds()
+
+    return (
+        (created + cache_expire_after)
+        .replace(tzinfo=datetime.timezone.utc)
+        .timestamp()
+    )
+
+
+def _cache_key(url):
+    request = cached_session.prepare_request(requests.Request("GET", url))
+
+    return cached_session.cache.create_key(request)
+
+
+def _coalesced_get(url):
+    """
+    Get a URL through the cache session, making sure only one request
+    for the URL is in flight at once in this worker.
+    Any other requests for the URL wait for, and share, its response.
+    """
+
+    with in_flight_requests_lock:
+        in_flight = in_flight_requests.get(url)
+
+        if not in_flight:
+            in_flight = in_flight_requests[url] = Future()
+            is_leader = True
+        else:
+            is_leader = False
+
+    if not is_leader:
+        coalesced_requests.labels(
+            domain=urlparse(url).netloc, scope="worker"
+        ).inc()
+
+        return in_flight.result()
+
+    try:
+        if coalesce_across_workers:
+            response = _coalesced_get_across_workers(url)
+        else:
+            response = _revalidating_get(url)
+    except Exception as request_error:
+        in_flight.set_exception(request_error)
+        raise request_error
+    else:
+        in_flight.set_result(response)
+    finally:
+        with in_flight_requests_lock:
+            del in_flight_requests[url]
+
+    return response
+
+
+def _coalesced_get_across_workers(url):
+    """
+    Take a lease on the URL in the shared cache while requesting it.
+    If another worker already holds a lease, wait for it to finish
+    so the request can be served from the cache it fills.
+    """
+
+    key = _cache_key(url)
+
+    if cache_backend.acquire_lease(key, seconds=coalesce_wait_seconds):
+        try:
+            return _revalidating_get(url)
+        finally:
+            cache_backend.release_lease(key)
+
+    coalesced_requests.labels(domain=urlparse(url).netloc, scope="node").inc()
+    deadline = time.time() + coalesce_wait_seconds
+
+    while cache_backend.has_lease(key) and time.time() < deadline:
+        time.sleep(0.05)
+
+    return _revalidating_get(url)
+
+
+def _revalidating_get(url):
+    """
+    Get a URL through the cache session.
+    If the cached response has expired, but has an ETag or Last-Modified
+    header, ask for it with If-None-Match or If-Modified-Since, so a 304
+    can renew the cached response without downloading it again.
+    """
+
+    key = _cache_key(url)
+    cached, created = cached_session.cache.get_response_and_time(key)
+
+    if cached is None:
+        return cached_session.get(url, timeout=3)
+
+    if datetime.datetime.utcnow() - created <= cache_expire_after:
+        # Another request already renewed it
+        cached.from_cache = True
+        return cached
+
+    validators = {}
+
+    if cached.headers.get("ETag"):
+        validators["If-None-Match"] = cached.headers["ETag"]
+
+    if cached.headers.get("Last-Modified"):
+        validators["If-Modified-Since"] = cached.headers["Last-Modified"]
+
+    if not validators:
+        return cached_session.get(url, timeout=3)
+
+    domain = urlparse(url).netloc
+    request = cached_session.prepare_request(
+        requests.Request("GET", url, headers=validators)
+    )
+    cached.from_cache = True
+
+    try:
+        # Bypass the cache, which would otherwise ignore a 304
+        response = _send_uncached(request)
+    except RequestException:
+        # Use the old response, as with `old_data_on_error`
+        revalidations.labels(domain=domain, result="failed").inc()
+        return cached
+
+    if response.status_code == 304:
+        for header in REVALIDATED_HEADERS:
+            if header in response.headers:
+                cached.headers[header] = response.headers[header]
+
+        cached_session.cache.save_response(key, cached)
+        cached.created_at = datetime.datetime.utcnow()
+        cached.revalidated = True
+        revalidations.labels(domain=domain, result="not_modified").inc()
+        revalidation_bytes_saved.labels(domain=domain).inc(
+            len(cached.content or b"")
+        )
+
+        return cached
+
+    if response.status_code == 200:
+        cached_session.cache.save_response(key, response)
+        response.from_cache = False
+        revalidations.labels(domain=domain, result="modified").inc()
+
+        return response
+
+    revalidations.labels(domain=domain, result="failed").inc()
+
+    return cached
+
+
+def _send_uncached(request):
+    """
+    Send a prepared request with the cache session's adapters,
+    bypassing its cache, but with the proxy and certificate settings
+    from the environment, as `cached_session.get` would use
+    """
+
+    settings = cached_session.merge_environment_settings(
+        request.url, {}, None, None, None
+    )
+
+    return requests.Session.send(
+        cached_session, request, timeout=3, **settings
+    )
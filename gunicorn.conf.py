@@ -0,0 +1,17 @@
+"""
+Gunicorn settings, see:
+http://docs.gunicorn.org/en/stable/settings.html
+"""
+
+
+def post_worker_init(worker):
+    """
+    Once a worker has forked and loaded the app,
+    warm up its cache in the background, until all the workers are warm
+    """
+
+    # Import inside the hook, so the master process never loads the app
+    import app
+    import warmup
+
+    warmup.start(app.app, workers=worker.cfg.workers)
@@ -1,6 +1,6 @@
 # Core
+import functools
 import re
-import textwrap
 import warnings
 from urllib.parse import urlencode, urlsplit
 import datetime
@@ -12,126 +12,366 @@ import werkzeug
 
 # Local
 import api
-
-
-def get_formatted_posts(**kwargs):
+import fanout
+import prefetch
+import taxonomy
+import timing
+
+
+CLOUDINARY = "https://res.cloudinary.com/canonical/image/fetch/q_auto,f_auto,"
+CLOUDINARY_SOURCE = 'src="https://res.cloudinary.com/canonical'
+IMAGE_SOURCE = ' src="'
+IMAGE_WITH_SRCSET = (
+    'img{{0}} decoding="async" src="{url}w_560/{{1}}"'
+    'srcset="{url}w_375/{{1}} 375w,'
+    '{url}w_480/{{1}} 480w, {url}w_560/{{1}} 560w"'
+    'sizes="(max-width: 375px) 280px,'
+    "(max-width: 480px) 440px,"
+    '560px"'.format(url=CLOUDINARY)
+)
+HTTP_CHARACTER = re.compile("[htp]")
+
+SUMMARY_LENGTH = 250
+SUMMARY_CACHE_SIZE = 1024
+# Tags, entities, and the text between them
+HTML_TOKEN = re.compile(r"(<[!/a-zA-Z][^>]*>?)|(&#?\w+;)|([^<&]+|[<&])")
+HTML_TAG = re.compile(r"<(/?)([^\s/>]*)(.*)", re.DOTALL)
+HEADING = re.compile(r"h\d$")
+VOID_ELEMENTS = {"area", "br", "col", "embed", "hr", "img", "input", "wbr"}
+WHITESPACE = re.compile(r"\s+")
+
+# The fields of embedded authors and featured images the templates use
+AUTHOR_FIELDS = ["id", "name", "link", "avatar_urls", "user_photo"]
+FEATURED_MEDIA_FIELDS = ["source_url", "alt_text"]
+
+DATE_CACHE_SIZE = 4096
+# The format WordPress uses for post dates
+ISO_DATE = re.compile(
+    r"([0-9]{4})-([0-9]{2})-([0-9]{2})T([0-9]{2}):([0-9]{2}):([0-9]{2})$"
+)
+
+
+def get_formatted_posts(listing=True, **kwargs):
     """
-    Get posts from API, then format the summary, date and link
+    Get posts from API, formatted as Posts.
+    Unless `listing` is False, only get the fields needed to list them.
     """
 
-    posts, total_posts, total_pages = api.get_posts(**kwargs)
-
-    for post in posts:
-        post = format_post(post)
+    if listing:
+        kwargs = _with_listing_fields(kwargs)
 
-    return posts, total_posts, total_pages
+    return _get_posts(kwargs)
 
 
 def get_formatted_expanded_posts(**kwargs):
     """
     Get posts from API, then format them and add the data for the first group
-    and category
+    and category. Only the fields needed to list them are requested.
     """
 
-    posts, total_posts, total_pages = api.get_posts(**kwargs)
+    posts, total_posts, total_pages = _get_posts(_with_listing_fields(kwargs))
 
     force_group = None
 
     if kwargs.get("group_ids"):
         force_group = kwargs.get("group_ids")[0]
 
+    groups = BatchLoader(taxonomy.groups.get_resources)
+    categories = BatchLoader(taxonomy.categories.get_resources)
+
     for post in posts:
-        post = format_post(post)
+        group_ids = post.group or []
+        post.group = force_group or (group_ids[0] if group_ids else None)
+        post.category = post.categories[0] if post.categories else None
 
-        post["group"] = get_first_group(
-            post.get("group", ""), force_group=force_group
-        )
+        groups.load(post.group)
+        categories.load(post.category)
+
+    with fanout.FanOut("expanded-posts") as fan:
+        requests = [
+            fan.submit(groups.dispatch),
+            fan.submit(categories.dispatch),
+        ]
+
+    for request in requests:
+        # Raise any errors from the API
+        request.result()
 
-        post["category"] = get_first_category(post["categories"])
+    for post in posts:
+        post.group = groups.get(post.group)
+        post.category = categories.get(post.category)
 
     return posts, total_posts, total_pages
 
 
-def get_first_group(group_ids, force_group=None):
+def _get_posts(kwargs):
     """
-    Retrieve the first group from a list of group_ids
+    Get posts from the API as Posts, and prefetch the next page
+    if the caller is paging through them (see prefetch.py)
     """
 
-    if force_group:
-        group_id = force_group
-    else:
-        group_id = group_ids[0] if group_ids else None
+    kwargs = dict(kwargs, prepare=format_posts)
+    posts, total_posts, total_pages = api.get_posts(**kwargs)
+
+    prefetch.after_page(api.get_posts, kwargs, total_pages)
+
+    return posts, total_posts, total_pages
+
 
-    return api.get_group(group_id) if group_id else None
+def _with_listing_fields(kwargs):
+    return {
+        "fields": api.LISTING_FIELDS,
+        "embeds": api.LISTING_EMBEDS,
+        **kwargs,
+    }
 
 
-def get_first_category(category_ids):
+class BatchLoader:
     """
-    Retrieve the first group from a list of group_ids
+    Collect the IDs of resources needed while building a response,
+    then retrieve them all with a single API call, e.g.:
+
+        groups = BatchLoader(api.get_groups)
+        groups.load(1479)
+        groups.load(1666)
+        groups.dispatch()  # Calls api.get_groups(ids=[1479, 1666])
+        group = groups.get(1479)
     """
 
-    return api.get_category(category_ids[0]) if category_ids else None
+    def __init__(self, get_resources):
+        self.get_resources = get_resources
+        self.ids = set()
+        self.resources = {}
+
+    def load(self, resource_id):
+        if resource_id:
+            self.ids.add(resource_id)
+
+    def dispatch(self):
+        missing_ids = self.ids.difference(self.resources)
+
+        if missing_ids:
+            for resource in self.get_resources(ids=list(missing_ids)):
+                self.resources[resource["id"]] = resource
+
+    def get(self, resource_id):
+        return self.resources.get(resource_id)
+
 
+class Post:
+    """
+    A formatted post, with only the fields the templates use.
+    The rest of the WordPress post (e.g. "_links", "guid", the excerpt)
+    isn't kept alive along with it.
+    """
 
+    __slots__ = [
+        "id",
+        "date",
+        "date_gmt",
+        "link",
+        "title",
+        "summary",
+        "content",
+        "author",
+        "featuredmedia",
+        "group",
+        "categories",
+        "category",
+        "tags",
+        "topic",
+        "start_date",
+        "end_date",
+        "_event_venue",
+        "_event_location",
+    ]
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+
+def format_posts(posts):
+    return [format_post(post) for post in posts]
+
+
+@timing.timed("formatting")
 def format_post(post):
     """
-    Transform post data by:
-    - Formatting the excerpt
-    - Putting the author at post['author']
-    - Formatting the data as e.g. 1 January 2017
-    - Making the link relative
+    Build a Post from WordPress post data by:
+    - Formatting the excerpt as a summary
+    - Taking the author and featured image from the embedded data
+    - Formatting the date as e.g. 1 January 2017
+    - Making the links relative
+    - Adding image sources for different screen sizes to the content
     """
 
-    if "author" in post["_embedded"] and post["_embedded"]["author"]:
-        post["author"] = post["_embedded"]["author"][0]
-        post["author"]["link"] = urlsplit(post["author"]["link"]).path.rstrip(
-            "/"
+    embedded = post.get("_embedded", {})
+    author = None
+    featuredmedia = None
+    content = None
+    start_date = None
+    end_date = None
+
+    if embedded.get("author"):
+        author = _pick(embedded["author"][0], AUTHOR_FIELDS)
+        author["link"] = urlsplit(author["link"]).path.rstrip("/")
+
+    if embedded.get("wp:featuredmedia"):
+        featuredmedia = _pick(
+            embedded["wp:featuredmedia"][0], FEATURED_MEDIA_FIELDS
         )
-    post["link"] = urlsplit(post["link"]).path.rstrip("/")
-    post["summary"] = format_summary(post["excerpt"]["rendered"])
-    post["date"] = format_date(post["date"])
 
-    if post["_start_month"]:
+    if post.get("_start_month"):
         start_month_name = get_month_name(int(post["_start_month"]))
-        post["start_date"] = "{} {} {}".format(
+        start_date = "{} {} {}".format(
             post["_start_day"], start_month_name, post["_start_year"]
         )
 
-    if post["_end_month"]:
+    if post.get("_end_month"):
         end_month_name = get_month_name(int(post["_end_month"]))
-        post["end_date"] = "{} {} {}".format(
+        end_date = "{} {} {}".format(
             post["_end_day"], end_month_name, post["_end_year"]
         )
 
-    if post["content"]:
-        CLOUDINARY = (
-            "https://res.cloudinary.com/"
-            "canonical/image/fetch/q_auto,f_auto,"
-        )
-        """
-        Remove existing cloudinary urls
-        """
-        post["content"]["rendered"] = re.sub(
-            r'img(.*)src="https://res.cloudinary.com/canonical'
-            r'(.[^http]*)/http(.[^"]*)"',
-            r'img\1 src="\3"',
-            post["content"]["rendered"],
-        )
-        """
-        Add cloudinary urls with a srcset
-        """
-        post["content"]["rendered"] = re.sub(
-            r"img(.*) src=\"(.[^\"]*)\"",
-            r'img\1 decoding="async" src="{url}w_560/\2"'
-            r'srcset="{url}w_375/\2 375w,'
-            r'{url}w_480/\2 480w, {url}w_560/\2 560w"'
-            r'sizes="(max-width: 375px) 280px,'
-            r"(max-width: 480px) 440px,"
-            r'560px"'.format(url=CLOUDINARY),
-            post["content"]["rendered"],
-        )
+    # Listings don't get the content (see api.LISTING_FIELDS)
+    if post.get("content"):
+        content = {"rendered": rewrite_images(post["content"]["rendered"])}
+
+    return Post(
+        id=post["id"],
+        date=format_date(post["date"]),
+        date_gmt=post.get("date_gmt"),
+        link=urlsplit(post["link"]).path.rstrip("/"),
+        title=post["title"],
+        summary=format_summary(post["excerpt"]["rendered"]),
+        content=content,
+        author=author,
+        featuredmedia=featuredmedia,
+        group=post.get("group"),
+        categories=post.get("categories"),
+        tags=post.get("tags"),
+        start_date=start_date,
+        end_date=end_date,
+        _event_venue=post.get("_event_venue"),
+        _event_location=post.get("_event_location"),
+    )
+
+
+def _pick(resource, names):
+    return {name: resource[name] for name in names if name in resource}
+
+
+def rewrite_images(content):
+    """
+    Serve images in post content through cloudinary, with a srcset:
+    - Remove existing cloudinary urls
+    - Add cloudinary urls with a srcset
+    """
+
+    content = _rewrite_image_sources(
+        content, CLOUDINARY_SOURCE, _match_cloudinary_url, 'img{} src="{}"'
+    )
+
+    return _rewrite_image_sources(
+        content, IMAGE_SOURCE, _match_image_url, IMAGE_WITH_SRCSET
+    )
+
+
+def _rewrite_image_sources(content, marker, match_url, template):
+    """
+    A linear scan over the content, equivalent to replacing
+    r"img(.*){marker}..." with `template`, where `match_url` finds the
+    url after a marker.
+
+    Like the greedy `img(.*)`, it rewrites the last matching marker
+    on the same line as the first "img", then continues after the url.
+    """
+
+    output = []
+    copied = 0
+    position = 0
+
+    while True:
+        start = content.find("img", position)
+
+        if start == -1:
+            break
+
+        line_end = content.find("\n", start)
+
+        if line_end == -1:
+            line_end = len(content)
+
+        search_end = line_end
+        url = None
 
-    return post
+        while url is None:
+            source = content.rfind(marker, start + 3, search_end)
+
+            if source == -1:
+                break
+
+            search_end = source + len(marker) - 1
+            url = match_url(content, source + len(marker))
+
+        if url is None:
+            # No other image on this line can match either
+            position = line_end + 1
+            continue
+
+        attributes = content[start:source][3:]
+        url_start, url_end = url
+        output.append(content[copied:start])
+        output.append(template.format(attributes, content[url_start:url_end]))
+        copied = position = url_end + 1
+
+    output.append(content[copied:])
+
+    return "".join(output)
+
+
+def _match_cloudinary_url(content, start):
+    """
+    Find the original url in a cloudinary path, as
+    r'(.[^http]*)/http(.[^"]*)"' would - which drops its "http"
+    """
+
+    if start >= len(content) or content[start] == "\n":
+        return None
+
+    path_end = HTTP_CHARACTER.search(content, start + 1)
+
+    if not path_end:
+        return None
+
+    slash = path_end.start() - 1
+    url_start = slash + 5
+
+    if (
+        slash <= start
+        or not content.startswith("/http", slash)
+        or url_start >= len(content)
+        or content[url_start] == "\n"
+    ):
+        return None
+
+    url_end = content.find('"', url_start + 1)
+
+    return (url_start, url_end) if url_end != -1 else None
+
+
+def _match_image_url(content, start):
+    """
+    Find the url in an image source, as r'(.[^"]*)"' would
+    """
+
+    if start >= len(content) or content[start] == "\n":
+        return None
+
+    url_end = content.find('"', start + 1)
+
+    return (start, url_end) if url_end != -1 else None
 
 
 def get_month_name(month_index):
@@ -143,36 +383,102 @@ def get_month_name(month_index):
     return datetime.date(1900, month_index, 1).strftime("%B")
 
 
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
 def format_date(date):
     """
     Make the date just how we like it, e.g.:
     1 January 2017
     """
 
-    return dateutil.parser.parse(date).strftime("%-d %B %Y")
+    return parse_date(date).strftime("%-d %B %Y")
+
+
+def parse_date(date):
+    """
+    Parse a date from the API, e.g. "2017-01-01T09:30:00",
+    falling back to dateutil for anything that isn't in that format
+    """
 
+    match = ISO_DATE.match(date)
 
+    if match:
+        try:
+            return datetime.datetime(*map(int, match.groups()))
+        except ValueError:
+            pass
+
+    return dateutil.parser.parse(date)
+
+
+@functools.lru_cache(maxsize=SUMMARY_CACHE_SIZE)
 def format_summary(excerpt):
     """
-    Format the excerpt in a post:
-    - Shorten to 250 chars
+    Format the excerpt in a post, in a single pass over its HTML:
+    - Shorten to 250 visible chars, on a wordbreak and with a ...
     - Remove images
     - Make headings into paragraphs
+    - Close any tags left open by shortening
+
+    Summaries are cached, as the same post appears on many listing pages.
     """
 
-    # shorten to 250 chars, on a wordbreak and with a ...
-    summary = textwrap.shorten(excerpt, width=250, placeholder="&hellip;")
+    # if there is a [...] replace with ...
+    excerpt = excerpt.replace("[&hellip;]", "&hellip;")
+
+    summary = []
+    open_tags = []
+    visible = 0
 
-    # replace headings (e.g. h1) to paragraphs
-    summary = re.sub(r"h\d>", "p>", summary)
+    for token in HTML_TOKEN.finditer(excerpt):
+        tag, entity, text = token.groups()
 
-    # remove images
-    summary = re.sub(r"<img(.[^>]*)?", "", summary)
+        if tag:
+            if tag[:2] == "<!":
+                summary.append(tag)
+                continue
 
-    # if there is a [...] replace with ...
-    summary = re.sub(r"\[\&hellip;\]", "&hellip;", summary)
+            closing, name, attributes = HTML_TAG.match(tag).groups()
+            name = name.lower()
+
+            # remove images
+            if name == "img":
+                continue
+
+            # replace headings (e.g. h1) to paragraphs
+            if HEADING.match(name):
+                name = "p"
+                tag = "<" + closing + name + attributes
+
+            if closing:
+                if name in open_tags:
+                    # close it, and anything left open inside it
+                    while open_tags.pop() != name:
+                        pass
+            elif name not in VOID_ELEMENTS and not attributes.endswith("/>"):
+                open_tags.append(name)
+
+            summary.append(tag)
+            continue
+
+        text = entity or WHITESPACE.sub(" ", text)
+        length = 1 if entity else len(text)
+
+        if visible + length > SUMMARY_LENGTH:
+            # shorten on a wordbreak, with a ...
+            if not entity:
+                end = SUMMARY_LENGTH - visible + 1
+                wordbreak = max(text.rfind(" ", 0, end), 0)
+                summary.append(text[:wordbreak])
+
+            summary = "".join(summary).rstrip() + "&hellip;"
+            closing_tags = ["</{}>".format(name) for name in open_tags]
+
+            return summary.lstrip() + "".join(reversed(closing_tags))
+
+        summary.append(text)
+        visible += length
 
-    return summary
+    return "".join(summary).strip()
 
 
 def monthname(month_number):
@@ -0,0 +1,179 @@
+# Core
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+# Third-party
+import flask
+import prometheus_client
+
+# Local
+import feeds
+import timing
+
+
+# Prometheus metric exporters
+page_cache_requests = prometheus_client.Counter(
+    "page_cache_requests",
+    "A counter of requests to cached views, by how they were served",
+    ["view", "result"],
+)
+
+# Page cache settings
+# Set PAGE_CACHE=true to cache the rendered HTML of views
+# decorated with `cached`, keeping up to PAGE_CACHE_MAX_ENTRIES pages
+enabled = os.environ.get("PAGE_CACHE", "").lower() in ["true", "1"]
+max_entries = int(os.environ.get("PAGE_CACHE_MAX_ENTRIES", 500))
+
+# Never cache pages under these paths
+BYPASS_PATHS = ["/search"]
+
+# key -> (body, mimetype, etag, expires), least recently used first
+_pages = OrderedDict()
+_pages_lock = threading.Lock()
+
+
+def cached(timeout):
+    """
+    Cache the HTML rendered by a view for `timeout` seconds,
+    or until the first of the upstream responses it was built from
+    expires from the cache (see timing.py), if sooner. E.g.:
+
+        @app.route("/archives")
+        @page_cache.cached(timeout=600)
+        def archives():
+            ...
+
+    Pages are served with strong ETags, and requests with
+    a matching If-None-Match header get a 304 without rendering.
+    """
+
+    timeout = min(timeout, feeds.cache_expire_after.total_seconds())
+
+    def cached_decorator(view):
+        @functools.wraps(view)
+        def cached_view(*args, **kwargs):
+            if not _should_cache():
+                return view(*args, **kwargs)
+
+            key = _page_key()
+            page = _get_page(key)
+
+            if page:
+                body, mimetype, etag, _ = page
+
+                if flask.request.if_none_match.contains(etag):
+                    _count(view, "not_modified")
+                    response = flask.Response(status=304)
+                    response.set_etag(etag)
+
+                    return response
+
+                _count(view, "hit")
+                response = flask.Response(body, mimetype=mimetype)
+                response.set_etag(etag)
+
+                return response
+
+            _count(view, "miss")
+            response = flask.make_response(view(*args, **kwargs))
+
+            expires = _expires(timeout)
+
+            if (
+                response.status_code == 200
+                and not response.is_streamed
+                and expires > time.time()
+            ):
+                body = response.get_data()
+                etag = hashlib.sha1(body).hexdigest()
+                response.set_etag(etag)
+
+                _set_page(key, (body, response.mimetype, etag, expires))
+
+            return response.make_conditional(flask.request)
+
+        return cached_view
+
+    return cached_decorator
+
+
+def clear():
+    with _pages_lock:
+        _pages.clear()
+
+
+def _should_cache():
+    if not enabled or flask.request.method != "GET":
+        return False
+
+    for path in BYPASS_PATHS:
+        if flask.request.path == path or flask.request.path.startswith(
+            path + "/"
+        ):
+            return False
+
+    return True
+
+
+def _expires(timeout):
+    """
+    When a page rendered now should expire, as a timestamp:
+    after `timeout` seconds, or when the first upstream response
+    used for the current request expires, if sooner
+    """
+
+    expires = time.time() + timeout
+    timings = timing.current()
+
+    if timings and timings.upstream_expires is not None:
+        expires = min(expires, timings.upstream_expires)
+
+    return expires
+
+
+def _page_key():
+    """
+    The path, plus the query string with its parameters sorted,
+    so "?page=2&category=a" and "?category=a&page=2" share a page
+    """
+
+    args = sorted(flask.request.args.items(multi=True))
+
+    return flask.request.path + "?" + urlencode(args)
+
+
+def _get_page(key):
+    with _pages_lock:
+        page = _pages.get(key)
+
+        if not page:
+            return None
+
+        if page[3] < time.time():
+            del _pages[key]
+            return None
+
+        _pages.move_to_end(key)
+
+        return page
+
+
+def _set_page(key, page):
+    with _pages_lock:
+        _pages[key] = page
+        _pages.move_to_end(key)
+
+        while len(_pages) > max_entries:
+            _pages.popitem(last=False)
+
+
+def _count(view, result):
+    if not timing.is_recorded():
+        return
+
+    page_cache_requests.labels(view=view.__name__, result=result).inc()
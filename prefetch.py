@@ -0,0 +1,128 @@
+# Core
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Third-party
+import prometheus_client
+
+
+# Prometheus metric exporters
+prefetch_requests = prometheus_client.Counter(
+    "prefetch_requests",
+    "A counter of next pages fetched in the background, by outcome",
+    ["outcome"],
+)
+prefetch_lookups = prometheus_client.Counter(
+    "prefetch_lookups",
+    "A counter of requests for later pages, by whether they were prefetched",
+    ["result"],
+)
+
+# Prefetch settings
+# Set PREFETCH=true to fetch the next page of paginated posts in the
+# background after each page, so it's already cached when it's clicked.
+# At most PREFETCH_MAX_IN_FLIGHT prefetches run at once in each worker,
+# and any more are skipped. A prefetched page counts as a hit if it's
+# requested within PREFETCH_HIT_SECONDS.
+enabled = os.environ.get("PREFETCH", "").lower() in ["true", "1"]
+max_in_flight = int(os.environ.get("PREFETCH_MAX_IN_FLIGHT", 2))
+hit_window = int(os.environ.get("PREFETCH_HIT_SECONDS", 3600))
+
+# The most prefetched pages to remember, to count hits
+MAX_ENTRIES = 1000
+
+executor = ThreadPoolExecutor(max_workers=max_in_flight)
+# key -> time prefetched, oldest first
+_prefetched = OrderedDict()
+_in_flight = set()
+_lock = threading.Lock()
+
+
+def after_page(get_page, kwargs, total_pages):
+    """
+    Call after getting a page with `get_page(**kwargs)`, to count whether
+    it was prefetched, and prefetch the next page if there is one:
+
+        posts, total_posts, total_pages = api.get_posts(**kwargs)
+        prefetch.after_page(api.get_posts, kwargs, total_pages)
+
+    Only callers paging through results (passing `page`) are prefetched for.
+    """
+
+    if not enabled or not kwargs.get("page"):
+        return
+
+    page = kwargs["page"]
+
+    if page > 1:
+        _count_lookup(_key(kwargs))
+
+    if not total_pages or page >= total_pages:
+        return
+
+    next_kwargs = dict(kwargs, page=page + 1)
+    key = _key(next_kwargs)
+
+    with _lock:
+        if key in _in_flight or _was_prefetched(key):
+            return
+
+        if len(_in_flight) >= max_in_flight:
+            prefetch_requests.labels(outcome="skipped").inc()
+            return
+
+        _in_flight.add(key)
+
+    executor.submit(_prefetch, get_page, next_kwargs, key)
+
+
+def _prefetch(get_page, kwargs, key):
+    try:
+        get_page(**kwargs)
+    except Exception as prefetch_error:
+        logging.getLogger(__name__).warning(
+            "Failed to prefetch page {}: {}".format(
+                kwargs["page"], str(prefetch_error)
+            )
+        )
+        outcome = "failed"
+    else:
+        outcome = "succeeded"
+
+        with _lock:
+            _prefetched[key] = time.time()
+            _prefetched.move_to_end(key)
+
+            while len(_prefetched) > MAX_ENTRIES:
+                _prefetched.popitem(last=False)
+    finally:
+        with _lock:
+            _in_flight.discard(key)
+
+    prefetch_requests.labels(outcome=outcome).inc()
+
+
+def _count_lookup(key):
+    """
+    Count a hit the first time a prefetched page is requested
+    """
+
+    with _lock:
+        hit = _was_prefetched(key)
+        _prefetched.pop(key, None)
+
+    prefetch_lookups.labels(result="hit" if hit else "miss").inc()
+
+
+def _was_prefetched(key):
+    prefetched = _prefetched.get(key)
+
+    return prefetched is not None and time.time() - prefetched < hit_window
+
+
+def _key(kwargs):
+    return repr(sorted(kwargs.items()))
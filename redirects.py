@@ -8,6 +8,11 @@ import yaml
 import yamlordereddictloader
 
 
+# Characters with a special meaning in regular expressions
+REGEX_CHARACTERS = set(".^$*+?{}[]\\|()")
+QUANTIFIERS = set("*+?{")
+
+
 class YamlRegexMap:
     def __init__(self, filepath):
         """
@@ -16,12 +21,23 @@ class YamlRegexMap:
             hello/(?P<person>.*)?: "/say-hello?name={person}"
             google/(?P<search>.*)?: "https://google.com/?q={search}"
 
-        Return a list of compiled Regex matches and destination strings:
+        Build a list of compiled Regex matches and destination strings:
 
             [
                 (<regex>, "/say-hello?name={person}"),
                 (<regex>, "https://google.com/?q={search}"),
             ]
+
+        And index them so a path can be matched without trying every regex:
+
+        - Literal paths (e.g. "/news/?") go in a dictionary of exact paths
+        - Other rules are grouped by the start of the first segment
+          of the path they can match, e.g. "/category/(?P<slug>.*)"
+          under "category/" or "/wp-(?P<page>.*)" under "wp-".
+          Rules which could start with anything, like "/foo|/bar",
+          are tried for every path
+        - The rules in each group are combined into a single regex,
+          which tries them in the order of the file
         """
 
         self.matches = []
@@ -41,23 +57,253 @@ class YamlRegexMap:
                             (re.compile(url_match), target_url)
                         )
 
-    def get_target(self, url_path):
-        for (match, target) in self.matches:
-            result = match.fullmatch(url_path)
+        self._build_index()
+
+    def _build_index(self):
+        # path -> index of the first literal rule for that path
+        self.exact_paths = {}
+        # start of the first segment -> indexes of the regex rules for it
+        prefix_rules = {}
+
+        for index, (match, target) in enumerate(self.matches):
+            if match.flags & re.IGNORECASE or _has_top_level_alternation(
+                match.pattern
+            ):
+                # May match paths starting with anything
+                prefix_rules.setdefault("", []).append(index)
+                continue
+
+            paths = _literal_paths(match.pattern)
+
+            if paths:
+                for path in paths:
+                    self.exact_paths.setdefault(path, index)
+            else:
+                prefix = _segment_prefix(_literal_prefix(match.pattern))
+                prefix_rules.setdefault(prefix, []).append(index)
+
+        self.prefix_matchers = {
+            prefix: self._combine(indexes)
+            for prefix, indexes in prefix_rules.items()
+        }
+
+    def _combine(self, indexes):
+        """
+        Combine the regexes for a list of rules into one regex,
+        which will fully match using the first rule that can,
+        and return a function to match a path against it,
+        returning the index of the rule and its named groups.
+
+        Combining renumbers groups, so rules which refer to groups
+        by number (e.g. "/(a)\\1") are tried on their own instead.
+        """
+
+        scanned = [
+            index
+            for index in indexes
+            if _refers_to_group_numbers(self.matches[index][0].pattern)
+        ]
+        indexes = [index for index in indexes if index not in scanned]
+
+        if not indexes:
+            return lambda url_path: self._scan(scanned, url_path)
+
+        alternatives = []
+
+        for index in indexes:
+            pattern = re.sub(
+                r"(?<!\\)\(\?P([<=])(\w+)",
+                r"(?P\1_{}_\2".format(index),
+                self.matches[index][0].pattern,
+            )
+            alternatives.append("(?P<_{}>{})".format(index, pattern))
+
+        try:
+            combined = re.compile("|".join(alternatives))
+        except re.error:
+            # Fall back to trying each rule's regex in turn
+            return lambda url_path: self._scan(
+                sorted(indexes + scanned), url_path
+            )
+
+        def match(url_path):
+            results = []
+            result = combined.fullmatch(url_path)
 
             if result:
-                parts = {}
-                for name, value in result.groupdict().items():
-                    parts[name] = value or ""
+                index = int(result.lastgroup[1:])
+                prefix = "_{}_".format(index)
+                groups = {
+                    name.split("_", 2)[2]: value
+                    for name, value in result.groupdict().items()
+                    if name.startswith(prefix)
+                }
+                results.append((index, groups))
+
+            scanned_result = self._scan(scanned, url_path)
+
+            if scanned_result:
+                results.append(scanned_result)
+
+            if results:
+                return min(results, key=lambda result: result[0])
+
+        return match
+
+    def _scan(self, indexes, url_path):
+        for index in indexes:
+            result = self.matches[index][0].fullmatch(url_path)
+
+            if result:
+                return index, result.groupdict()
+
+    def find(self, url_path):
+        """
+        Find the target URL for a path, without the query string
+        """
+
+        results = []
+        exact_index = self.exact_paths.get(url_path)
+
+        if exact_index is not None:
+            results.append((exact_index, {}))
+
+        for prefix in _segment_prefixes(url_path):
+            matcher = self.prefix_matchers.get(prefix)
+
+            if matcher:
+                result = matcher(url_path)
+
+                if result:
+                    results.append(result)
+
+        if results:
+            # The first matching rule in the file wins
+            index, groups = min(results, key=lambda result: result[0])
+            parts = {}
+            for name, value in groups.items():
+                parts[name] = value or ""
+
+            return self.matches[index][1].format(**parts)
+
+    def get_target(self, url_path):
+        target_url = self.find(url_path)
+
+        if target_url:
+            if flask.request.query_string:
+                target_url += "?" + flask.request.query_string.decode("utf-8")
+
+            return target_url
+
+
+def _literal_paths(pattern):
+    """
+    If a pattern only matches literal paths, return them, e.g.:
+
+        "/news" -> ["/news"]
+        "/news/?" -> ["/news", "/news/"]
+        "/news/.*" -> None
+    """
+
+    if not REGEX_CHARACTERS.intersection(pattern):
+        return [pattern]
+
+    if (
+        pattern.endswith("?")
+        and len(pattern) > 2
+        and not REGEX_CHARACTERS.intersection(pattern[:-1])
+    ):
+        return [pattern[:-2], pattern[:-1]]
+
+    return None
+
+
+def _literal_prefix(pattern):
+    """
+    The literal text that every match of a pattern starts with
+    """
+
+    for position, character in enumerate(pattern):
+        if character in REGEX_CHARACTERS:
+            if character in QUANTIFIERS:
+                # The previous character may not be matched
+                position -= 1
+
+            return pattern[:position]
+
+    return pattern
+
+
+def _has_top_level_alternation(pattern):
+    """
+    Whether a pattern has a "|" outside any group or character class,
+    so its literal prefix only covers the first alternative:
+
+        "/foo|/bar" -> True
+        "/(foo|bar)" -> False
+    """
+
+    depth = 0
+    in_class = False
+    escaped = False
+
+    for character in pattern:
+        if escaped:
+            escaped = False
+        elif character == "\\":
+            escaped = True
+        elif in_class:
+            in_class = character != "]"
+        elif character == "[":
+            in_class = True
+        elif character == "(":
+            depth += 1
+        elif character == ")":
+            depth -= 1
+        elif character == "|" and depth == 0:
+            return True
+
+    return False
+
+
+def _refers_to_group_numbers(pattern):
+    """
+    Whether a pattern has a numbered backreference, like "\\1",
+    or a conditional on a group, like "(?(1)...)"
+    """
+
+    return bool(re.search(r"\\[1-9]|\(\?\(", pattern))
+
+
+def _segment_prefix(prefix):
+    """
+    Given the literal prefix of a pattern, return the part of
+    the first segment it covers, plus its closing slash if included:
+
+        "/category/news-" -> "category/"
+        "/wp-" -> "wp-"
+    """
+
+    end = prefix.find("/", 1)
+
+    return prefix[1:] if end == -1 else prefix[1:end] + "/"
+
+
+def _segment_prefixes(path):
+    """
+    All the segment prefixes which could be the start of a path:
+
+        "/wp-admin/x" -> ["", "w", "wp", "wp-", ... "wp-admin", "wp-admin/"]
+    """
 
-                target_url = target.format(**parts)
+    end = path.find("/", 1)
+    segment = path[1:end] if end != -1 else path[1:]
+    prefixes = [segment[:length] for length in range(len(segment) + 1)]
 
-                if flask.request.query_string:
-                    target_url += "?" + flask.request.query_string.decode(
-                        "utf-8"
-                    )
+    if end != -1:
+        prefixes.append(segment + "/")
 
-                return target_url
+    return prefixes
 
 
 def prepare_redirects(
@@ -0,0 +1,296 @@
+# Core
+import heapq
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+# Third-party
+import prometheus_client
+
+# Local
+import api
+import helpers
+import taxonomy
+
+
+# Prometheus metric exporters
+related_posts_lookups = prometheus_client.Counter(
+    "related_posts_lookups",
+    "A counter of related posts lookups, by whether the local index answered",
+    ["result"],
+)
+related_posts_syncs = prometheus_client.Counter(
+    "related_posts_syncs",
+    "A counter of related posts index syncs, by kind and outcome",
+    ["kind", "outcome"],
+)
+
+# Related posts settings
+# Every post's tags are synced in bulk into a local index, which is saved
+# as a JSON snapshot in TAXONOMY_SNAPSHOT_DIR for new workers to load.
+# Posts changed since the last sync are fetched every RELATED_SYNC_SECONDS,
+# and the whole index is rebuilt every RELATED_REBUILD_SECONDS,
+# to drop deleted posts, both bypassing the cache.
+sync_interval = int(os.environ.get("RELATED_SYNC_SECONDS", 600))
+rebuild_interval = int(os.environ.get("RELATED_REBUILD_SECONDS", 86400))
+
+PER_PAGE = 100
+# The post fields needed to relate posts, and to link to them
+SYNC_FIELDS = ["id", "date", "modified", "link", "title", "excerpt", "tags"]
+
+
+class RelatedPostsIndex:
+    """
+    An in-process index from each tag to the posts with it, to find
+    the posts sharing the most tags with a post without an API call:
+
+        index = RelatedPostsIndex()
+        related_posts = index.get_related(post.id, post.tags)
+
+    Until the index has loaded, `get_related` returns None,
+    so the caller can ask the API instead.
+    """
+
+    def __init__(self):
+        self.snapshot_path = os.path.join(
+            taxonomy.snapshot_dir, "insights-related-posts.json"
+        )
+        # post ID -> (date, modified, tag IDs, Post)
+        self.posts = {}
+        # tag ID -> post IDs
+        self.tag_posts = {}
+        self.synced = 0
+        self.rebuilt = 0
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+        self._load_snapshot()
+
+    def get_related(self, post_id, tag_ids, count=3):
+        """
+        The `count` posts sharing the most tags with this post,
+        most recent first when they share as many,
+        or None if the index hasn't loaded.
+        Like the API, with no tags it returns the latest posts.
+        """
+
+        self._sync_in_background_if_stale()
+
+        if not self.rebuilt:
+            related_posts_lookups.labels(result="not_loaded").inc()
+            return None
+
+        scores = Counter()
+
+        with self._lock:
+            for tag_id in tag_ids:
+                scores.update(self.tag_posts.get(tag_id, ()))
+
+            candidates = scores if tag_ids else self.posts
+            related_ids = heapq.nlargest(
+                count,
+                (
+                    related_id
+                    for related_id in candidates
+                    if related_id != post_id
+                ),
+                key=lambda related_id: (
+                    scores[related_id],
+                    self.posts[related_id][0],
+                ),
+            )
+            related_posts = [
+                self.posts[related_id][3] for related_id in related_ids
+            ]
+
+        related_posts_lookups.labels(result="local").inc()
+
+        return related_posts
+
+    def sync(self):
+        """
+        Add posts changed since the last sync to the index,
+        or rebuild it from every post if it's due
+        """
+
+        if not self._sync_lock.acquire(blocking=False):
+            # Already syncing
+            return
+
+        if time.time() - self.rebuilt > rebuild_interval:
+            kind = "rebuild"
+        else:
+            kind = "changes"
+
+        try:
+            if kind == "rebuild":
+                self._rebuild()
+            else:
+                self._sync_changes()
+
+            self._save_snapshot()
+        except Exception as request_error:
+            logging.getLogger(__name__).warning(
+                "Failed to sync related posts: {}".format(str(request_error))
+            )
+            related_posts_syncs.labels(kind=kind, outcome="failed").inc()
+        else:
+            related_posts_syncs.labels(kind=kind, outcome="succeeded").inc()
+        finally:
+            self.synced = time.time()
+            self._sync_lock.release()
+
+    def _rebuild(self):
+        """
+        Replace the index with every post from the API
+        """
+
+        resources = taxonomy.get_all_pages(self._get_page)
+        posts = {}
+        tag_posts = {}
+
+        for resource in resources:
+            _add_post(posts, tag_posts, _entry(resource))
+
+        with self._lock:
+            self.posts = posts
+            self.tag_posts = tag_posts
+
+        self.rebuilt = time.time()
+
+    def _sync_changes(self):
+        """
+        Request the most recently modified posts, page by page,
+        until reaching posts already in the index
+        """
+
+        last_modified = max(
+            (entry[1] for entry in self.posts.values()), default=""
+        )
+        changed = []
+        page = 1
+
+        while True:
+            response = self._get_page(page, orderby="modified")
+            resources = response.json()
+            changed += [
+                resource
+                for resource in resources
+                if resource["modified"] > last_modified
+            ]
+            total_pages = helpers.to_int(
+                response.headers.get("X-WP-TotalPages"), 1
+            )
+
+            if (
+                page >= total_pages
+                or not resources
+                or resources[-1]["modified"] <= last_modified
+            ):
+                break
+
+            page += 1
+
+        with self._lock:
+            for resource in changed:
+                _add_post(self.posts, self.tag_posts, _entry(resource))
+
+    def _get_page(self, page, orderby=None):
+        return api.get(
+            "posts",
+            {
+                "_fields": ",".join(SYNC_FIELDS),
+                "per_page": PER_PAGE,
+                "page": page,
+                "orderby": orderby,
+            },
+            fresh=True,
+        )
+
+    def _sync_in_background_if_stale(self):
+        if time.time() - self.synced > sync_interval:
+            self.synced = time.time()
+            threading.Thread(target=self.sync, daemon=True).start()
+
+    def _load_snapshot(self):
+        """
+        Load the index from the snapshot, unless it's missing,
+        wasn't saved by this user, or isn't a valid snapshot
+        """
+
+        posts = {}
+        tag_posts = {}
+
+        try:
+            snapshot, saved = taxonomy.load_snapshot(self.snapshot_path)
+
+            for date, modified, tag_ids, fields in snapshot["posts"]:
+                post = helpers.Post(
+                    date=helpers.format_date(date), tags=tag_ids, **fields
+                )
+                _add_post(posts, tag_posts, (date, modified, tag_ids, post))
+
+            rebuilt = float(snapshot["rebuilt"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+
+        self.posts = posts
+        self.tag_posts = tag_posts
+        self.rebuilt = rebuilt
+        self.synced = saved
+
+    def _save_snapshot(self):
+        with self._lock:
+            posts = [
+                [
+                    date,
+                    modified,
+                    tag_ids,
+                    {
+                        "id": post.id,
+                        "link": post.link,
+                        "title": post.title,
+                        "summary": post.summary,
+                    },
+                ]
+                for date, modified, tag_ids, post in self.posts.values()
+            ]
+
+        taxonomy.save_snapshot(
+            self.snapshot_path, {"rebuilt": self.rebuilt, "posts": posts}
+        )
+
+
+def _entry(resource):
+    return (
+        resource["date"],
+        resource["modified"],
+        resource.get("tags") or [],
+        helpers.format_post(resource),
+    )
+
+
+def _add_post(posts, tag_posts, entry):
+    """
+    Add a post to the index, replacing any earlier version of it.
+    Posts the API leaves out of listings (see api.EXCLUDED_TAG_IDS)
+    are removed instead.
+    """
+
+    _, _, tag_ids, post = entry
+
+    for tag_id in posts.pop(post.id, (None, None, []))[2]:
+        tag_posts[tag_id].discard(post.id)
+
+    if set(tag_ids).intersection(api.EXCLUDED_TAG_IDS):
+        return
+
+    posts[post.id] = entry
+
+    for tag_id in tag_ids:
+        tag_posts.setdefault(tag_id, set()).add(post.id)
+
+
+index = RelatedPostsIndex()
@@ -0,0 +1,248 @@
+# Core
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Third-party
+import prometheus_client
+
+# Local
+import api
+import helpers
+from cache import open_private_file, private_directory
+
+
+# Prometheus metric exporters
+taxonomy_lookups = prometheus_client.Counter(
+    "taxonomy_lookups",
+    "A counter of taxonomy lookups, by whether they were in the local index",
+    ["taxonomy", "result"],
+)
+taxonomy_refreshes = prometheus_client.Counter(
+    "taxonomy_refreshes",
+    "A counter of bulk taxonomy refreshes, by outcome",
+    ["taxonomy", "outcome"],
+)
+
+# Taxonomy index settings
+# Every group, category and tag is fetched in bulk, and refreshed
+# in the background every TAXONOMY_REFRESH_SECONDS, bypassing the cache.
+# Each refresh is saved as a JSON snapshot in TAXONOMY_SNAPSHOT_DIR,
+# or a temporary directory only this user can use,
+# which new workers load when they start.
+refresh_interval = int(os.environ.get("TAXONOMY_REFRESH_SECONDS", 600))
+snapshot_dir = os.environ.get("TAXONOMY_SNAPSHOT_DIR") or private_directory(
+    "insights-cache"
+)
+
+# Background sync settings
+# Bulk syncs (of this and the related posts index) request their pages
+# with their own TAXONOMY_SYNC_MAX_WORKERS threads, rather than
+# fanout.executor, so requests never queue behind them
+sync_max_workers = int(os.environ.get("TAXONOMY_SYNC_MAX_WORKERS", 2))
+sync_executor = ThreadPoolExecutor(max_workers=sync_max_workers)
+
+PER_PAGE = 100
+
+
+class TaxonomyIndex:
+    """
+    An in-process index of every resource at an API endpoint,
+    e.g. every group, to look them up by slug or ID without an API call:
+
+        groups = TaxonomyIndex("group")
+        group = groups.get_by_slug("cloud-and-server")
+
+    Resources missing from the index (e.g. created since the last refresh)
+    are requested from the API as before, and added to the index.
+    """
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.snapshot_path = os.path.join(
+            snapshot_dir, "insights-taxonomy-{}.json".format(endpoint)
+        )
+        self.slugs = {}
+        self.ids = {}
+        self.refreshed = 0
+        self._refresh_lock = threading.Lock()
+
+        self._load_snapshot()
+
+    def get_by_slug(self, slug):
+        return next(iter(self.get_resources(slugs=[slug])), None)
+
+    def get_by_id(self, resource_id):
+        return next(iter(self.get_resources(ids=[resource_id])), None)
+
+    def get_resources(self, slugs=[], ids=[]):
+        """
+        Get the resources for these slugs and IDs.
+        Any which aren't in the index are requested from the API.
+        """
+
+        self._refresh_in_background_if_stale()
+
+        resources = []
+        missing_slugs = []
+        missing_ids = []
+
+        for slug in slugs:
+            resource = self.slugs.get(slug)
+
+            if resource:
+                resources.append(resource)
+            else:
+                missing_slugs.append(slug)
+
+        for resource_id in ids:
+            resource = self.ids.get(resource_id)
+
+            if resource:
+                resources.append(resource)
+            else:
+                missing_ids.append(resource_id)
+
+        self._count("hit", len(resources))
+        self._count("miss", len(missing_slugs) + len(missing_ids))
+
+        if missing_slugs:
+            resources += self._request({"slug": ",".join(missing_slugs)})
+
+        if missing_ids:
+            resources += self._request(
+                {
+                    "include": helpers.join_ids(sorted(missing_ids)),
+                    "per_page": PER_PAGE,
+                }
+            )
+
+        return resources
+
+    def refresh(self):
+        """
+        Replace the index with every resource from the API
+        """
+
+        if not self._refresh_lock.acquire(blocking=False):
+            # Already refreshing
+            return
+
+        try:
+            resources = get_all_pages(self._get_page)
+
+            self._set_resources(resources)
+            save_snapshot(self.snapshot_path, resources)
+        except Exception as request_error:
+            logging.getLogger(__name__).warning(
+                "Failed to refresh {}: {}".format(
+                    self.endpoint, str(request_error)
+                )
+            )
+            taxonomy_refreshes.labels(
+                taxonomy=self.endpoint, outcome="failed"
+            ).inc()
+        else:
+            taxonomy_refreshes.labels(
+                taxonomy=self.endpoint, outcome="succeeded"
+            ).inc()
+        finally:
+            self.refreshed = time.time()
+            self._refresh_lock.release()
+
+    def _get_page(self, page):
+        return api.get(
+            self.endpoint, {"per_page": PER_PAGE, "page": page}, fresh=True
+        )
+
+    def _request(self, parameters):
+        resources = api.get(self.endpoint, parameters).json()
+
+        for resource in resources:
+            self.slugs[resource["slug"]] = resource
+            self.ids[resource["id"]] = resource
+
+        return resources
+
+    def _refresh_in_background_if_stale(self):
+        if time.time() - self.refreshed > refresh_interval:
+            self.refreshed = time.time()
+            threading.Thread(target=self.refresh, daemon=True).start()
+
+    def _set_resources(self, resources):
+        self.slugs = {resource["slug"]: resource for resource in resources}
+        self.ids = {resource["id"]: resource for resource in resources}
+
+    def _load_snapshot(self):
+        try:
+            resources, saved = load_snapshot(self.snapshot_path)
+            self._set_resources(resources)
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+
+        self.refreshed = saved
+
+    def _count(self, result, lookups):
+        if lookups:
+            taxonomy_lookups.labels(taxonomy=self.endpoint, result=result).inc(
+                lookups
+            )
+
+
+def get_all_pages(get_page):
+    """
+    Every resource from a paginated API endpoint, given a function
+    returning the response for a page of it. The pages after the first
+    are all requested at once, with the background sync threads.
+    """
+
+    response = get_page(1)
+    resources = response.json()
+    total_pages = helpers.to_int(response.headers.get("X-WP-TotalPages"), 1)
+
+    pages = [
+        sync_executor.submit(get_page, page)
+        for page in range(2, total_pages + 1)
+    ]
+
+    for page in pages:
+        resources += page.result().json()
+
+    return resources
+
+
+def load_snapshot(path):
+    """
+    The data in a JSON snapshot, and the time it was saved.
+    Raises PermissionError if it wasn't saved by the current user.
+    """
+
+    with os.fdopen(open_private_file(path, os.O_RDONLY)) as snapshot_file:
+        saved = os.fstat(snapshot_file.fileno()).st_mtime
+
+        return json.load(snapshot_file), saved
+
+
+def save_snapshot(path, data):
+    """
+    Save data as a JSON snapshot, writing it to a temporary file first,
+    so other workers never load a partial snapshot.
+    Only the current user can read or replace it.
+    """
+
+    temporary_path = "{}.{}".format(path, os.getpid())
+    descriptor = open_private_file(temporary_path, os.O_WRONLY | os.O_CREAT)
+    os.ftruncate(descriptor, 0)
+
+    with os.fdopen(descriptor, "w") as snapshot_file:
+        json.dump(data, snapshot_file)
+
+    os.replace(temporary_path, path)
+
+
+groups = TaxonomyIndex("group")
+categories = TaxonomyIndex("categories")
+tags = TaxonomyIndex("tags")
@@ -1,12 +1,48 @@
 # Core
+import asyncio
+import datetime
+import json
+import threading
+import os
+import subprocess
+import tempfile
 import unittest
 import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import urlparse, urlunparse
 
+# Third-party
+import flask
+import prometheus_client
+import requests
+
 # Local
+import api
 import app
-from api import get
-from helpers import ignore_warnings
+import async_api
+import fanout
+import feeds
+import page_cache
+import prefetch
+import taxonomy
+import timing
+import warmup
+from api import LISTING_FIELDS, get
+from cache import MemoryCache, SQLiteCache, private_directory
+from fanout import FanOut
+from helpers import (
+    BatchLoader,
+    CLOUDINARY,
+    format_date,
+    format_post,
+    format_summary,
+    ignore_warnings,
+    rewrite_images,
+)
+from redirects import YamlRegexMap
+from related import RelatedPostsIndex
+from taxonomy import TaxonomyIndex
+from transport import RecordingAdapter, ReplayAdapter, ResponseArchive
 
 
 test_content = "Ubuntu and Canonical are registered"
@@ -153,5 +189,1144 @@ class WebAppTestCase(unittest.TestCase):
         return response
 
 
+class FanOutTestCase(unittest.TestCase):
+    def test_concurrent_calls(self):
+        with FanOut("test") as fan:
+            first = fan.submit(time.sleep, 0.2)
+            second = fan.submit(time.sleep, 0.2)
+
+        assert first.done() and second.done()
+        assert fan.busy_seconds >= 0.4
+
+    def test_nested_calls(self):
+        def nested():
+            with FanOut("nested") as fan:
+                return fan.submit(sum, [1, 2]).result()
+
+        with FanOut("test") as fan:
+            result = fan.submit(nested)
+
+        assert result.result() == 3
+
+
+class TimingTestCase(unittest.TestCase):
+    def tearDown(self):
+        app.app.debug = False
+
+    def test_calls_in_other_threads(self):
+        timing.start_request()
+
+        with FanOut("test") as fan:
+            fan.submit(timing.record_upstream_call, 0.1, from_cache=False)
+            fan.submit(timing.record_upstream_call, 0.2, from_cache=True)
+
+        timings = timing.current()
+
+        assert timings.upstream_calls == 2
+        assert timings.cached_calls == 1
+        # The calls overlapped, so only the longest counts
+        assert abs(timings.upstream_seconds() - 0.2) < 0.05
+
+    def test_upstream_wall_time(self):
+        timings = timing.RequestTimings()
+        timings.upstream_intervals = [(0, 1), (0.5, 2), (3, 3.5), (1.5, 1.8)]
+
+        assert timings.upstream_seconds() == 2.5
+
+    def test_server_timing_in_debug(self):
+        client = app.app.test_client()
+
+        assert "Server-Timing" not in client.get("/search").headers
+
+        app.app.debug = True
+        server_timing = client.get("/search").headers["Server-Timing"]
+
+        assert 'upstream;dur=0.0;desc="0 calls, 0 cached"' in server_timing
+        assert "render;dur=" in server_timing
+
+
+class AsyncAPITestCase(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_gather(self):
+        slow_call = async_api._coroutine(lambda: time.sleep(0.2) or "done")
+
+        async def gather_calls():
+            return await asyncio.gather(slow_call(), slow_call(), slow_call())
+
+        start = time.time()
+        results = self.loop.run_until_complete(gather_calls())
+
+        assert results == ["done", "done", "done"]
+        assert time.time() - start < 0.5
+
+    def test_limit_kept_after_timeout(self):
+        settings = (async_api.max_per_host, async_api.timeout)
+        async_api.max_per_host, async_api.timeout = 1, 0.05
+        slow_call = async_api._coroutine(lambda: time.sleep(0.3) or "done")
+        fast_call = async_api._coroutine(lambda: "done")
+
+        async def call_after_timeout():
+            with self.assertRaises(asyncio.TimeoutError):
+                await slow_call()
+
+            start = time.time()
+            result = await fast_call()
+
+            # Waited for the slow call's thread to finish
+            return result, time.time() - start
+
+        try:
+            result, waited = self.loop.run_until_complete(call_after_timeout())
+        finally:
+            async_api.max_per_host, async_api.timeout = settings
+
+        assert result == "done"
+        assert waited > 0.15
+
+
+class BatchLoaderTestCase(unittest.TestCase):
+    def test_single_lookup(self):
+        calls = []
+
+        def get_resources(ids):
+            calls.append(sorted(ids))
+            return [{"id": resource_id} for resource_id in ids]
+
+        loader = BatchLoader(get_resources)
+
+        for resource_id in [3, 1, 3, None, 2]:
+            loader.load(resource_id)
+
+        loader.dispatch()
+        loader.dispatch()
+
+        assert calls == [[1, 2, 3]]
+        assert loader.get(2) == {"id": 2}
+        assert loader.get(None) is None
+
+
+class SQLiteCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+
+        self.response = requests.Response()
+        self.response.status_code = 200
+        self.response._content = b"[]"
+        self.response.request = requests.Request(
+            "GET", "https://example.com"
+        ).prepare()
+
+    def tearDown(self):
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def test_shared_between_instances(self):
+        hour = datetime.timedelta(hours=1)
+        writer = SQLiteCache(self.path, expire_after=hour)
+        reader = SQLiteCache(self.path, expire_after=hour)
+
+        writer.save_response("key", self.response)
+        response, created = reader.get_response_and_time("key")
+
+        assert response.content == b"[]"
+        assert datetime.datetime.utcnow() - created < hour
+
+    def test_per_entry_expiry(self):
+        hour = datetime.timedelta(hours=1)
+        cache = SQLiteCache(self.path, expire_after=hour)
+
+        cache.save_response("short", self.response, expire_after=hour / 2)
+        cache.save_response("long", self.response)
+
+        # Remove entries which will have expired 45 minutes from now
+        cache.remove_old_entries(datetime.datetime.utcnow() - hour / 4)
+
+        assert not cache.has_key("short")
+        assert cache.has_key("long")
+
+    def test_least_recently_used_eviction(self):
+        hour = datetime.timedelta(hours=1)
+        cache = SQLiteCache(self.path, expire_after=hour, max_entries=2)
+
+        cache.save_response("first", self.response)
+        cache.save_response("second", self.response)
+        cache.save_response("third", self.response)
+        cache.remove_old_entries(datetime.datetime.utcnow() - hour)
+
+        assert not cache.has_key("first")
+        assert cache.has_key("second") and cache.has_key("third")
+
+    def test_private_files(self):
+        hour = datetime.timedelta(hours=1)
+        system_temp_dir = tempfile.tempdir
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            tempfile.tempdir = temp_dir
+
+            try:
+                cache_dir = private_directory("cache")
+                path = os.path.join(cache_dir, "cache.sqlite")
+                SQLiteCache(path, expire_after=hour)
+
+                assert os.stat(cache_dir).st_mode & 0o777 == 0o700
+                assert os.stat(path).st_mode & 0o777 == 0o600
+
+                # Anyone could have created a file through a symlink
+                os.symlink(path, path + ".link")
+
+                with self.assertRaises(OSError):
+                    SQLiteCache(path + ".link", expire_after=hour)
+
+                # Anyone could have created files in the directory
+                os.chmod(cache_dir, 0o777)
+
+                with self.assertRaises(PermissionError):
+                    private_directory("cache")
+            finally:
+                tempfile.tempdir = system_temp_dir
+
+
+class MemoryCacheTestCase(unittest.TestCase):
+    def test_least_recently_used_eviction(self):
+        response = requests.Response()
+        response._content = b"12345"
+        response.request = requests.Request(
+            "GET", "https://example.com"
+        ).prepare()
+
+        cache = MemoryCache(max_bytes=10)
+
+        cache.save_response("first", response)
+        cache.save_response("second", response)
+        cache.get_response_and_time("first")
+        cache.save_response("third", response)
+
+        assert cache.has_key("first") and cache.has_key("third")
+        assert not cache.has_key("second")
+        assert cache.total_bytes == 10
+
+
+class PageCacheTestCase(unittest.TestCase):
+    def test_normalised_key(self):
+        with app.app.test_request_context("/archives?page=2&year=2018"):
+            first_key = page_cache._page_key()
+
+        with app.app.test_request_context("/archives?year=2018&page=2"):
+            second_key = page_cache._page_key()
+
+        assert first_key == second_key
+
+    def test_bypass(self):
+        page_cache.enabled = True
+
+        try:
+            with app.app.test_request_context("/search?q=lxd"):
+                assert not page_cache._should_cache()
+
+            with app.app.test_request_context("/search-engine-tips"):
+                assert page_cache._should_cache()
+        finally:
+            page_cache.enabled = False
+
+    def test_not_modified(self):
+        cached_app = flask.Flask(__name__)
+        cached_app.add_url_rule(
+            "/cached", "cached", page_cache.cached(timeout=60)(lambda: "Hi")
+        )
+        client = cached_app.test_client()
+        page_cache.enabled = True
+
+        try:
+            client.get("/cached")
+            response = client.get("/cached")
+            not_modified = client.get(
+                "/cached", headers={"If-None-Match": response.headers["ETag"]}
+            )
+        finally:
+            page_cache.enabled = False
+            page_cache.clear()
+
+        assert response.status_code == 200
+        assert not_modified.status_code == 304
+        assert response.headers["ETag"].startswith('"')
+        assert not_modified.headers["ETag"] == response.headers["ETag"]
+
+    def test_expires_with_upstream_responses(self):
+        response = requests.Response()
+        response._content = b"[]"
+        response.request = requests.Request(
+            "GET", "https://example.com"
+        ).prepare()
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = SQLiteCache(
+                os.path.join(cache_dir, "cache.sqlite"),
+                expire_after=datetime.timedelta(hours=1),
+            )
+            # As if it was cached 59 minutes ago
+            cache.save_response(
+                "key", response, expire_after=datetime.timedelta(minutes=1)
+            )
+            cached, _ = cache.get_response_and_time("key")
+
+        cached.from_cache = True
+        expires = feeds._expires(cached)
+
+        assert abs(expires - (time.time() + 60)) < 5
+
+        timing.start_request()
+        timing.record_upstream_call(0, from_cache=True, expires=expires)
+
+        assert page_cache._expires(600) == expires
+
+
+class RewriteImagesTestCase(unittest.TestCase):
+    def test_cloudinary_srcset(self):
+        content = (
+            '<p>Intro</p>\n<img class="a" src="https://a.com/1.png" />\n'
+            '<img src="https://res.cloudinary.com/canonical/w_560/'
+            'https://a.com/2.png" />'
+        )
+
+        rewritten = rewrite_images(content).split("\n")
+
+        assert rewritten[0] == "<p>Intro</p>"
+        assert rewritten[1].startswith(
+            '<img class="a" decoding="async" '
+            'src="{}w_560/https://a.com/1.png"'.format(CLOUDINARY)
+        )
+        assert (
+            'srcset="{}w_375/https://a.com/1.png 375w,'.format(CLOUDINARY)
+            in rewritten[1]
+        )
+        # The original url loses its "http", as it always has
+        assert rewritten[2].startswith(
+            '<img  decoding="async" src="{}w_560/s://a.com/2.png"'.format(
+                CLOUDINARY
+            )
+        )
+
+
+class FormatSummaryTestCase(unittest.TestCase):
+    def test_formatting(self):
+        summary = format_summary(
+            '<h2>Title</h2>\n<p>An <img src="a.png" /> image [&hellip;]</p>'
+        )
+
+        assert summary == "<p>Title</p> <p>An  image &hellip;</p>"
+
+    def test_shortening(self):
+        summary = format_summary(
+            "<p><strong>" + "word " * 100 + "</strong> more</p>"
+        )
+
+        assert summary.endswith("word&hellip;</strong></p>")
+        assert summary.count("word") == 50
+
+
+class FormatDateTestCase(unittest.TestCase):
+    def test_formats(self):
+        assert format_date("2017-01-01T09:30:00") == "1 January 2017"
+        # Not from the API, so parsed by dateutil
+        assert format_date("Jan 2 2017") == "2 January 2017"
+
+
+class FormatPostTestCase(unittest.TestCase):
+    def test_listing_fields(self):
+        post = {field: "" for field in LISTING_FIELDS}
+        post.update(
+            link="https://admin.insights.ubuntu.com/2017/01/01/a-post/",
+            excerpt={"rendered": "<p>A summary</p>"},
+            date="2017-01-01T09:30:00",
+            _embedded={},
+        )
+
+        post = format_post(post)
+
+        assert post.content is None
+        assert post.link == "/2017/01/01/a-post"
+        assert post.summary == "<p>A summary</p>"
+
+    def test_embedded_author(self):
+        post = {field: "" for field in LISTING_FIELDS}
+        post.update(
+            link="https://admin.insights.ubuntu.com/2017/01/01/a-post/",
+            excerpt={"rendered": ""},
+            date="2017-01-01T09:30:00",
+            _embedded={
+                "author": [
+                    {
+                        "id": 1,
+                        "name": "Canonical",
+                        "link": "https://example.com/author/canonical/",
+                        "description": "Not used by the templates",
+                    }
+                ]
+            },
+        )
+
+        author = format_post(post).author
+
+        assert author == {
+            "id": 1,
+            "name": "Canonical",
+            "link": "/author/canonical",
+        }
+
+
+class PrefetchTestCase(unittest.TestCase):
+    def setUp(self):
+        prefetch.enabled = True
+        self.pages = []
+
+    def tearDown(self):
+        prefetch.enabled = False
+
+    def get_page(self, page, **kwargs):
+        self.pages.append(page)
+
+    def wait_for_prefetches(self):
+        while prefetch._in_flight:
+            time.sleep(0.01)
+
+    def test_next_page(self):
+        prefetch.after_page(self.get_page, {"page": 1, "tag_ids": [1]}, 3)
+        self.wait_for_prefetches()
+
+        assert self.pages == [2]
+        assert prefetch._was_prefetched(
+            prefetch._key({"page": 2, "tag_ids": [1]})
+        )
+
+    def test_last_page(self):
+        prefetch.after_page(self.get_page, {"page": 3, "tag_ids": [2]}, 3)
+        prefetch.after_page(self.get_page, {"tag_ids": [2]}, 3)
+        self.wait_for_prefetches()
+
+        assert self.pages == []
+
+
+class WarmupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.slow_app = flask.Flask(__name__)
+        self.slow_app.add_url_rule(
+            "/slow", "slow", lambda: time.sleep(0.2) or "done"
+        )
+        timing.register(self.slow_app)
+        self.settings = (warmup.TAXONOMIES, warmup.PAGE_PATHS, warmup.timeout)
+        warmup.TAXONOMIES = []
+        warmup.PAGE_PATHS = ["/slow"]
+
+    def tearDown(self):
+        warmup.TAXONOMIES, warmup.PAGE_PATHS, warmup.timeout = self.settings
+
+    def test_ready_after_warm_up(self):
+        warmup.start(self.slow_app)
+
+        client = app.app.test_client()
+
+        assert not warmup.is_ready()
+        assert client.get("/status/ready").status_code == 503
+        # Still alive, so liveness checks don't restart it
+        assert client.get("/status").status_code == 200
+
+        time.sleep(0.5)
+
+        assert warmup.is_ready()
+        assert client.get("/status/ready").status_code == 200
+
+    def test_ready_after_all_workers(self):
+        warmup.timeout = 1
+        warmup.start(self.slow_app, workers=2)
+
+        assert wait_until(warmup._ready.is_set)
+
+        # This worker is warm, but the other isn't
+        assert not warmup.is_ready()
+
+        other_worker = subprocess.Popen(["sleep", "5"])
+        other_marker = os.path.join(warmup._marker_dir, str(other_worker.pid))
+
+        try:
+            open(other_marker, "w").close()
+
+            assert warmup.is_ready()
+        finally:
+            other_worker.kill()
+            other_worker.wait()
+            os.remove(other_marker)
+            os.remove(warmup._marker_path())
+
+        # Still ready after the other worker has stopped
+        assert warmup.is_ready()
+
+    def test_warm_up_not_recorded(self):
+        def slow_requests():
+            return (
+                prometheus_client.REGISTRY.get_sample_value(
+                    "request_upstream_calls_count", {"view": "slow"}
+                )
+                or 0
+            )
+
+        recorded = slow_requests()
+        warmup.start(self.slow_app)
+        time.sleep(0.5)
+
+        assert slow_requests() == recorded
+
+        self.slow_app.test_client().get("/slow")
+
+        assert slow_requests() == recorded + 1
+
+    def test_ready_after_timeout(self):
+        warmup.timeout = 0
+
+        warmup.start(self.slow_app)
+
+        assert warmup.is_ready()
+
+
+class TaxonomyIndexTestCase(unittest.TestCase):
+    def test_snapshot_lookups(self):
+        groups = TaxonomyIndex("group")
+
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as snapshot:
+            json.dump([{"id": 1479, "slug": "cloud-and-server"}], snapshot)
+            snapshot.flush()
+            groups.snapshot_path = snapshot.name
+            groups._load_snapshot()
+
+        assert groups.get_by_slug("cloud-and-server")["id"] == 1479
+        assert groups.get_by_id(1479)["slug"] == "cloud-and-server"
+
+    def test_private_snapshots(self):
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            path = os.path.join(snapshot_dir, "snapshot.json")
+            taxonomy.save_snapshot(path, [{"id": 1479}])
+
+            assert os.stat(path).st_mode & 0o777 == 0o600
+            assert taxonomy.load_snapshot(path)[0] == [{"id": 1479}]
+
+            # Anyone could have created the temporary file as a symlink
+            os.symlink(
+                os.path.join(snapshot_dir, "elsewhere"),
+                "{}.{}".format(path, os.getpid()),
+            )
+
+            with self.assertRaises(OSError):
+                taxonomy.save_snapshot(path, [])
+
+            assert not os.path.exists(os.path.join(snapshot_dir, "elsewhere"))
+
+    def test_all_pages_outside_request_pool(self):
+        threads = set()
+
+        def get_page(page):
+            threads.add(threading.current_thread().name)
+            response = requests.Response()
+            response._content = json.dumps([{"id": page}]).encode()
+            response.headers["X-WP-TotalPages"] = "3"
+
+            return response
+
+        resources = taxonomy.get_all_pages(get_page)
+
+        assert [resource["id"] for resource in resources] == [1, 2, 3]
+        assert not any(
+            name.startswith(fanout.executor._thread_name_prefix + "_")
+            for name in threads
+        )
+
+
+class RelatedPostsIndexTestCase(unittest.TestCase):
+    def post(self, post_id, date, tag_ids):
+        fields = {"id": post_id, "link": "", "title": {}, "summary": ""}
+
+        return [date, date, tag_ids, fields]
+
+    def test_most_shared_tags(self):
+        index = RelatedPostsIndex()
+        posts = [
+            self.post(1, "2018-01-01T00:00:00", [10, 11, 12]),
+            self.post(2, "2018-01-02T00:00:00", [10]),
+            self.post(3, "2018-01-03T00:00:00", [10, 11]),
+            self.post(4, "2018-01-04T00:00:00", [12]),
+            # Tagged "lang:jp", so never related
+            self.post(5, "2018-01-05T00:00:00", [10, 11, 12, 3184]),
+        ]
+
+        with tempfile.NamedTemporaryFile("w", suffix=".json") as snapshot:
+            json.dump({"rebuilt": time.time(), "posts": posts}, snapshot)
+            snapshot.flush()
+            index.snapshot_path = snapshot.name
+            index._load_snapshot()
+
+        related_posts = index.get_related(1, [10, 11, 12], count=3)
+
+        assert [post.id for post in related_posts] == [3, 4, 2]
+
+        # Like the API, the latest posts for a post without tags
+        related_posts = index.get_related(4, [], count=2)
+
+        assert [post.id for post in related_posts] == [3, 2]
+
+    def test_invalid_snapshot(self):
+        index = RelatedPostsIndex()
+        index.rebuilt = 0
+
+        for snapshot_data in [[], {"posts": [[1]]}, {"posts": "x"}]:
+            with tempfile.NamedTemporaryFile("w", suffix=".json") as snapshot:
+                json.dump(snapshot_data, snapshot)
+                snapshot.flush()
+                index.snapshot_path = snapshot.name
+                index._load_snapshot()
+
+            assert not index.rebuilt
+
+
+class RSSFeedContentTestCase(unittest.TestCase):
+    def setUp(self):
+        self.response = requests.Response()
+        self.response.status_code = 200
+        self.response._content = (
+            b"<rss><channel><title>Feed</title>"
+            b"<item><guid>1</guid><pubDate>Mon, 01 Jan 2018 00:00:00 GMT"
+            b"</pubDate></item>"
+            b"<item><guid>2</guid></item>"
+            b"<item><guid>3</guid></item>"
+            b"</channel></rss>"
+        )
+        self.cached_request = feeds.cached_request
+        feeds.cached_request = lambda url: self.response
+
+    def tearDown(self):
+        feeds.cached_request = self.cached_request
+
+    def test_parsed_once(self):
+        self.response.headers["ETag"] = "1"
+
+        entries = feeds.get_rss_feed_content(
+            "https://example.com/feed", exclude_items_in=[{"guid": "2"}]
+        )
+
+        assert [entry["guid"] for entry in entries] == ["1", "3"]
+        assert entries[0]["updated_datetime"].year == 2018
+
+        # A response with the same ETag isn't parsed again
+        self.response._content = b"Not a feed"
+
+        entries = feeds.get_rss_feed_content(
+            "https://example.com/feed", offset=1, limit=1
+        )
+
+        assert [entry["guid"] for entry in entries] == ["2"]
+
+
+class StubAPIHandler(BaseHTTPRequestHandler):
+    """
+    Serves the same JSON body, with an ETag,
+    and a 304 with new caching headers when asked for it with that ETag
+    """
+
+    body = b'[{"id": 1}]'
+    # The If-None-Match header of each request
+    received = []
+
+    def do_GET(self):
+        self.received.append(self.headers.get("If-None-Match"))
+
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.send_header("Cache-Control", "max-age=60")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipUnless(
+    isinstance(feeds.cache_backend, SQLiteCache),
+    "Expiring a single response needs the SQLite cache",
+)
+class RevalidationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), StubAPIHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = "http://127.0.0.1:{}/posts".format(self.server.server_port)
+        StubAPIHandler.received = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        feeds.cached_session.cache.delete(feeds._cache_key(self.url))
+
+    def test_not_modified(self):
+        assert feeds.cached_request(self.url).json() == [{"id": 1}]
+
+        # Expire the response, past the stale window
+        key = feeds._cache_key(self.url)
+        response, _ = feeds.cached_session.cache.get_response_and_time(key)
+        feeds.cached_session.cache.save_response(
+            key, response, expire_after=datetime.timedelta(days=-1)
+        )
+
+        response = feeds.cached_request(self.url)
+
+        assert response.json() == [{"id": 1}]
+        assert StubAPIHandler.received == [None, '"v1"']
+
+        # The 304 renewed the cached response, and its headers
+        cached, created = feeds.cached_session.cache.get_response_and_time(key)
+        age = datetime.datetime.utcnow() - created
+
+        assert age < datetime.timedelta(minutes=1)
+        assert cached.headers["Cache-Control"] == "max-age=60"
+        assert cached.headers["ETag"] == '"v1"'
+
+    def test_environment_settings(self):
+        proxy = "http://127.0.0.1:{}".format(self.server.server_port)
+        request = feeds.cached_session.prepare_request(
+            requests.Request("GET", "http://insights.invalid/posts")
+        )
+        environment = dict(os.environ)
+        os.environ.update(http_proxy=proxy, HTTP_PROXY=proxy, no_proxy="")
+        os.environ.pop("NO_PROXY", None)
+
+        try:
+            # Only reachable through the stub server, as a proxy
+            response = feeds._send_uncached(request)
+        finally:
+            os.environ.clear()
+            os.environ.update(environment)
+
+        assert response.json() == [{"id": 1}]
+
+    def test_fresh_request(self):
+        feeds.cached_request(self.url)
+        response = feeds.fresh_request(self.url)
+
+        # Requested again, though cached, and without the ETag
+        assert StubAPIHandler.received == [None, None]
+        assert not response.from_cache
+        assert response.json() == [{"id": 1}]
+
+        # Cached for requests which don't need to be fresh
+        assert feeds.cached_request(self.url).from_cache
+        assert len(StubAPIHandler.received) == 2
+
+
+class GatedStubAPIHandler(StubAPIHandler):
+    """
+    The stub API, holding every response until the gate is open
+    """
+
+    gate = threading.Event()
+
+    def do_GET(self):
+        self.gate.wait(5)
+        super().do_GET()
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+    return condition()
+
+
+@unittest.skipUnless(
+    isinstance(feeds.cache_backend, SQLiteCache),
+    "Expiring a single response needs the SQLite cache",
+)
+class StaleWhileRevalidateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), GatedStubAPIHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.domain = "127.0.0.1:{}".format(self.server.server_port)
+        self.urls = [
+            "http://{}/posts".format(self.domain),
+            "http://{}/posts?page=2".format(self.domain),
+        ]
+        GatedStubAPIHandler.received = []
+        GatedStubAPIHandler.gate.set()
+
+        for url in self.urls:
+            feeds.cached_request(url)
+
+            # Expire the response, within the stale window
+            key = feeds._cache_key(url)
+            response, _ = feeds.cached_session.cache.get_response_and_time(key)
+            feeds.cached_session.cache.save_response(
+                key, response, expire_after=datetime.timedelta(minutes=-1)
+            )
+
+        GatedStubAPIHandler.received = []
+        GatedStubAPIHandler.gate.clear()
+
+    def tearDown(self):
+        feeds.max_background_refreshes = 4
+        GatedStubAPIHandler.gate.set()
+        wait_until(lambda: not feeds.refreshing_keys)
+        self.server.shutdown()
+        self.server.server_close()
+
+        for url in self.urls:
+            feeds.cached_session.cache.delete(feeds._cache_key(url))
+
+    def refreshes(self, outcome):
+        return (
+            prometheus_client.REGISTRY.get_sample_value(
+                "feed_background_refreshes_total",
+                {"domain": self.domain, "outcome": outcome},
+            )
+            or 0
+        )
+
+    def test_stale_served_while_refreshing(self):
+        started = time.time()
+        response = feeds.cached_request(self.urls[0])
+
+        # Served without waiting for the held refresh
+        assert time.time() - started < 1
+        assert response.json() == [{"id": 1}]
+        assert feeds.refreshing_keys == {feeds._cache_key(self.urls[0])}
+
+        GatedStubAPIHandler.gate.set()
+
+        assert wait_until(lambda: self.refreshes("succeeded") == 1)
+        assert GatedStubAPIHandler.received == ['"v1"']
+
+    def test_refreshed_once(self):
+        for _ in range(3):
+            feeds.cached_request(self.urls[0])
+
+        GatedStubAPIHandler.gate.set()
+
+        assert wait_until(lambda: not feeds.refreshing_keys)
+        assert GatedStubAPIHandler.received == ['"v1"']
+
+        # The refresh renewed the response, so it isn't refreshed again
+        feeds.cached_request(self.urls[0])
+
+        assert not feeds.refreshing_keys
+
+    def test_skipped_beyond_max_refreshes(self):
+        feeds.max_background_refreshes = 1
+
+        first = feeds.cached_request(self.urls[0])
+        second = feeds.cached_request(self.urls[1])
+
+        assert first.json() == second.json() == [{"id": 1}]
+        assert feeds.refreshing_keys == {feeds._cache_key(self.urls[0])}
+        assert self.refreshes("skipped") == 1
+
+
+@unittest.skipUnless(
+    isinstance(feeds.cache_backend, SQLiteCache),
+    "Coalescing across workers needs the SQLite cache",
+)
+class CoalescingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), GatedStubAPIHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.domain = "127.0.0.1:{}".format(self.server.server_port)
+        self.url = "http://{}/posts".format(self.domain)
+        self.key = feeds._cache_key(self.url)
+        GatedStubAPIHandler.received = []
+        GatedStubAPIHandler.gate.set()
+
+    def tearDown(self):
+        GatedStubAPIHandler.gate.set()
+        self.server.shutdown()
+        self.server.server_close()
+        feeds.cache_backend.release_lease(self.key)
+        feeds.cached_session.cache.delete(self.key)
+
+    def coalesced(self, scope):
+        return (
+            prometheus_client.REGISTRY.get_sample_value(
+                "feed_coalesced_requests_total",
+                {"domain": self.domain, "scope": scope},
+            )
+            or 0
+        )
+
+    def test_one_request_per_url(self):
+        GatedStubAPIHandler.gate.clear()
+        responses = []
+        threads = [
+            threading.Thread(
+                target=lambda: responses.append(feeds.cached_request(self.url))
+            )
+            for _ in range(5)
+        ]
+
+        for thread in threads:
+            thread.start()
+
+        # Every other request is waiting on the first one
+        assert wait_until(lambda: self.coalesced("worker") == 4)
+
+        GatedStubAPIHandler.gate.set()
+
+        for thread in threads:
+            thread.join()
+
+        assert len(GatedStubAPIHandler.received) == 1
+        assert [response.json() for response in responses] == [[{"id": 1}]] * 5
+
+    def test_wait_for_other_worker(self):
+        # As if another worker is requesting the URL
+        assert feeds.cache_backend.acquire_lease(self.key, seconds=5)
+
+        responses = []
+        waiting = threading.Thread(
+            target=lambda: responses.append(
+                feeds._coalesced_get_across_workers(self.url)
+            )
+        )
+        waiting.start()
+
+        assert wait_until(lambda: self.coalesced("node") == 1)
+
+        feeds.cached_session.get(self.url)
+        feeds.cache_backend.release_lease(self.key)
+        waiting.join()
+
+        assert responses[0].from_cache
+        assert responses[0].json() == [{"id": 1}]
+        assert len(GatedStubAPIHandler.received) == 1
+
+    def test_lease_lapses(self):
+        assert feeds.cache_backend.acquire_lease(self.key, seconds=5)
+        assert feeds.cache_backend.has_lease(self.key)
+        assert not feeds.cache_backend.acquire_lease(self.key, seconds=5)
+
+        feeds.cache_backend.release_lease(self.key)
+
+        # As if the worker holding the lease died without releasing it
+        assert feeds.cache_backend.acquire_lease(self.key, seconds=0.2)
+
+        started = time.time()
+        response = feeds._coalesced_get_across_workers(self.url)
+
+        assert not feeds.cache_backend.has_lease(self.key)
+        assert 0.1 < time.time() - started < 2
+        assert response.json() == [{"id": 1}]
+        assert len(GatedStubAPIHandler.received) == 1
+
+
+class TransportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(("127.0.0.1", 0), StubAPIHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+        self.url = "http://127.0.0.1:{}/posts".format(self.server.server_port)
+        self.archive_path = os.path.join(
+            tempfile.mkdtemp(), "archive.jsonl.gz"
+        )
+
+    def tearDown(self):
+        self.server.server_close()
+
+    def test_record_and_replay(self):
+        archive = ResponseArchive(self.archive_path)
+        session = requests.Session()
+        session.mount(
+            "http://",
+            RecordingAdapter(requests.adapters.HTTPAdapter(), archive),
+        )
+
+        assert session.get(self.url).json() == [{"id": 1}]
+
+        archive.close()
+        self.server.shutdown()
+
+        session = requests.Session()
+        session.mount(
+            "http://", ReplayAdapter(ResponseArchive(self.archive_path))
+        )
+        response = session.get(self.url)
+
+        assert response.json() == [{"id": 1}]
+        assert response.headers["ETag"] == '"v1"'
+        assert (
+            session.get(
+                self.url, headers={"If-None-Match": '"v1"'}
+            ).status_code
+            == 304
+        )
+
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            session.get(self.url + "?page=2")
+
+    def test_workers_sharing_archive(self):
+        self.server.shutdown()
+
+        def recorded(url):
+            response = requests.Response()
+            response.status_code = 200
+            response._content = url.encode()
+            response.request = requests.Request("GET", url).prepare()
+
+            return response.request, response
+
+        # As if two workers recorded to the same archive at once
+        first = ResponseArchive(self.archive_path)
+        second = ResponseArchive(self.archive_path)
+        first.add(*recorded("https://example.com/1"))
+        second.add(*recorded("https://example.com/2"))
+        first.add(*recorded("https://example.com/3"))
+        first.close()
+        second.close()
+
+        with open(self.archive_path, "ab") as archive_file:
+            archive_file.write(b"Not gzip")
+
+        archive = ResponseArchive(self.archive_path)
+
+        for number in ["1", "2", "3"]:
+            url = "https://example.com/" + number
+
+            assert archive.get("GET", url)[3] == url.encode()
+
+
+class ListingEmbedsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.get = api.get
+        self.requests = []
+        api.get = self.fake_get
+
+    def tearDown(self):
+        api.get = self.get
+        api.embeds_with_fields = True
+
+    def fake_get(self, endpoint, parameters={}):
+        self.requests.append(parameters)
+        post = {"id": 1, "_links": {"author": []}}
+
+        if not parameters["_fields"]:
+            # Like WordPress before 5.4, only embedding without _fields
+            post["_embedded"] = {"wp:featuredmedia": [{"id": 2}]}
+
+        response = requests.Response()
+        response.url = "https://example.com/posts?" + str(parameters)
+        response._content = json.dumps([post]).encode()
+
+        return response
+
+    def test_whole_posts_without_embeds(self):
+        for _ in range(2):
+            posts, _, _ = api.get_posts(
+                fields=api.LISTING_FIELDS, embeds=api.LISTING_EMBEDS
+            )
+
+            assert posts[0]["featuredmedia"] == {"id": 2}
+
+        assert [request["_fields"] for request in self.requests] == [
+            ",".join(api.LISTING_FIELDS),
+            None,
+            None,
+        ]
+        assert self.requests[-1]["_embed"] is True
+
+
+class DecodedJSONTestCase(unittest.TestCase):
+    def test_changes_are_not_kept(self):
+        response = requests.Response()
+        response.url = "https://example.com/posts"
+        response._content = b'[{"id": 1, "title": {"rendered": "A post"}}]'
+
+        posts = feeds.decoded_json(response)
+        posts[0]["id"] = 2
+        posts.append({"id": 3})
+
+        assert feeds.decoded_json(response) == [
+            {"id": 1, "title": {"rendered": "A post"}}
+        ]
+
+
+class ReplaceInChunksTestCase(unittest.TestCase):
+    def test_match_across_chunks(self):
+        chunks = [b"<link>https://admin.ins", b"ights.ubuntu.com/</link>"]
+
+        rewritten = feeds._replace_in_chunks(
+            iter(chunks), b"admin.insights.ubuntu.com", b"insights.ubuntu.com"
+        )
+
+        assert b"".join(rewritten) == (
+            b"<link>https://insights.ubuntu.com/</link>"
+        )
+
+
+class YamlRegexMapTestCase(unittest.TestCase):
+    def test_file_order(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".yaml") as rules:
+            rules.write(
+                "/news/(?P<slug>.*): /first/{slug}\n"
+                "/news/exact: /second\n"
+                "/exact/?: /third\n"
+                "/ex(?P<rest>.*): /fourth{rest}\n"
+            )
+            rules.flush()
+            redirect_map = YamlRegexMap(rules.name)
+
+        assert redirect_map.find("/news/exact") == "/first/exact"
+        assert redirect_map.find("/exact/") == "/third"
+        assert redirect_map.find("/example") == "/fourthample"
+        assert redirect_map.find("/missing") is None
+
+    def test_alternation(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".yaml") as rules:
+            rules.write(
+                '"/foo|/bar": /x\n'
+                '"/(baz|qux)/(?P<slug>.*)": /y/{slug}\n'
+                '"/news/(?P<slug>a|b)": /z/{slug}\n'
+            )
+            rules.flush()
+            redirect_map = YamlRegexMap(rules.name)
+
+        assert redirect_map.find("/foo") == "/x"
+        assert redirect_map.find("/bar") == "/x"
+        assert redirect_map.find("/qux/hello") == "/y/hello"
+        assert redirect_map.find("/news/b") == "/z/b"
+        assert redirect_map.find("/news/c") is None
+
+    def test_numbered_backreferences(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".yaml") as rules:
+            rules.write(
+                "/(b)c: /bc\n"
+                "/(a)\\1: /double\n"
+                "/(?P<letter>[a-z])/(b)\\2: /{letter}\n"
+                "/a(?P<rest>.*): /single{rest}\n"
+            )
+            rules.flush()
+            redirect_map = YamlRegexMap(rules.name)
+
+        assert redirect_map.find("/bc") == "/bc"
+        assert redirect_map.find("/aa") == "/double"
+        assert redirect_map.find("/x/bb") == "/x"
+        assert redirect_map.find("/ab") == "/singleb"
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,272 @@
+# Core
+import functools
+import threading
+import time
+
+# Third-party
+import flask
+import prometheus_client
+
+
+# Prometheus metric exporters
+request_upstream_calls = prometheus_client.Histogram(
+    "request_upstream_calls",
+    "API and feed requests made to build a response, cached or not, by view",
+    ["view"],
+    buckets=[0, 1, 2, 4, 8, 16, 32],
+)
+request_upstream_seconds = prometheus_client.Histogram(
+    "request_upstream_seconds",
+    "Wall time waiting on API and feed requests for a response, by view",
+    ["view"],
+    buckets=[0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5],
+)
+request_formatting_seconds = prometheus_client.Histogram(
+    "request_formatting_seconds",
+    "Time spent formatting posts to build a response, by view",
+    ["view"],
+    buckets=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25],
+)
+request_render_seconds = prometheus_client.Histogram(
+    "request_render_seconds",
+    "Time spent rendering templates to build a response, by view",
+    ["view"],
+    buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5],
+)
+
+# The metric for the time spent in each phase of a request
+PHASES = {
+    "upstream": request_upstream_seconds,
+    "formatting": request_formatting_seconds,
+    "render": request_render_seconds,
+}
+
+# Requests with this set in their WSGI environ, like warm-up renders
+# (see warmup.py), aren't recorded in request metrics
+UNRECORDED_ENVIRON_KEY = "insights.unrecorded"
+
+_thread_state = threading.local()
+
+
+class RequestTimings:
+    """
+    Where the time to build a single response went.
+    Threads working on the request (see `carry`) all add to it.
+    Upstream time is the wall time spent waiting on any upstream call,
+    so concurrent calls count once, while other phases are summed.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.upstream_calls = 0
+        self.cached_calls = 0
+        # When the first upstream response used expires from the cache
+        self.upstream_expires = None
+        self.seconds = {phase: 0 for phase in PHASES}
+        # (started, finished) for each upstream call
+        self.upstream_intervals = []
+        self._lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self._lock:
+            self.seconds[phase] += seconds
+
+    def add_upstream_call(self, seconds, from_cache, expires=None):
+        finished = time.time()
+
+        with self._lock:
+            self.upstream_calls += 1
+            self.cached_calls += 1 if from_cache else 0
+            self.upstream_intervals.append((finished - seconds, finished))
+
+            if expires is not None and (
+                self.upstream_expires is None
+                or expires < self.upstream_expires
+            ):
+                self.upstream_expires = expires
+
+    def phase_seconds(self, phase):
+        if phase == "upstream":
+            return self.upstream_seconds()
+
+        return self.seconds[phase]
+
+    def upstream_seconds(self):
+        """
+        The time when at least one upstream call was in progress
+        """
+
+        with self._lock:
+            intervals = sorted(self.upstream_intervals)
+
+        total = 0
+        span_start, span_end = None, None
+
+        for started, finished in intervals:
+            if span_end is None or started > span_end:
+                if span_end is not None:
+                    total += span_end - span_start
+
+                span_start, span_end = started, finished
+            else:
+                span_end = max(span_end, finished)
+
+        if span_end is not None:
+            total += span_end - span_start
+
+        return total
+
+    def server_timing(self):
+        """
+        The timings as a Server-Timing header, for the browser's dev tools
+        """
+
+        metrics = [
+            '{};dur={:.1f};desc="{} calls, {} cached"'.format(
+                "upstream",
+                self.upstream_seconds() * 1000,
+                self.upstream_calls,
+                self.cached_calls,
+            )
+        ]
+        metrics += [
+            "{};dur={:.1f}".format(phase, self.seconds[phase] * 1000)
+            for phase in ["formatting", "render"]
+        ]
+        metrics.append(
+            "total;dur={:.1f}".format((time.time() - self.started) * 1000)
+        )
+
+        return ", ".join(metrics)
+
+
+def register(app):
+    """
+    Time every request to the app, recording the metrics above
+    by view, and adding a Server-Timing header in debug mode
+    """
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    flask.before_render_template.connect(_start_render, app)
+    flask.template_rendered.connect(_finish_render, app)
+
+
+def current():
+    """
+    The timings for the request this thread is working on, if any
+    """
+
+    return getattr(_thread_state, "timings", None)
+
+
+def start_request():
+    _thread_state.timings = RequestTimings()
+
+
+def finish_request(response):
+    timings = current()
+    _thread_state.timings = None
+
+    if not timings:
+        return response
+
+    if flask.current_app.debug:
+        response.headers["Server-Timing"] = timings.server_timing()
+
+    if not is_recorded():
+        return response
+
+    view = flask.request.endpoint or "none"
+
+    request_upstream_calls.labels(view=view).observe(timings.upstream_calls)
+
+    for phase, histogram in PHASES.items():
+        histogram.labels(view=view).observe(timings.phase_seconds(phase))
+
+    return response
+
+
+def is_recorded():
+    """
+    Whether the current request should count towards request metrics
+    """
+
+    return not flask.request.environ.get(UNRECORDED_ENVIRON_KEY)
+
+
+def record_upstream_call(seconds, from_cache, expires=None):
+    """
+    Count an upstream call towards the current request, along with
+    when the response it got expires from the cache, as a timestamp
+    """
+
+    timings = current()
+
+    if timings:
+        timings.add_upstream_call(seconds, from_cache, expires)
+
+
+def timed(phase):
+    """
+    Add the time spent in a function to a phase of the current request:
+
+        @timing.timed("formatting")
+        def format_post(post):
+            ...
+    """
+
+    def timed_decorator(function):
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            timings = current()
+
+            if not timings:
+                return function(*args, **kwargs)
+
+            start = time.time()
+
+            try:
+                return function(*args, **kwargs)
+            finally:
+                timings.add(phase, time.time() - start)
+
+        return timed_function
+
+    return timed_decorator
+
+
+def carry(function):
+    """
+    Wrap a function to run in another thread (e.g. in fanout.py),
+    so its time still counts towards the current request
+    """
+
+    timings = current()
+
+    if not timings:
+        return function
+
+    @functools.wraps(function)
+    def carried_function(*args, **kwargs):
+        previous = current()
+        _thread_state.timings = timings
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _thread_state.timings = previous
+
+    return carried_function
+
+
+def _start_render(sender, template, context, **extra):
+    _thread_state.render_started = time.time()
+
+
+def _finish_render(sender, template, context, **extra):
+    timings = current()
+    started = getattr(_thread_state, "render_started", None)
+
+    if timings and started:
+        timings.add("render", time.time() - started)
@@ -0,0 +1,187 @@
+# Core
+import atexit
+import base64
+import fcntl
+import gzip
+import io
+import json
+import threading
+import zlib
+
+# Third-party
+import prometheus_client
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+
+# Prometheus metric exporters
+archive_misses = prometheus_client.Counter(
+    "feed_archive_misses",
+    "A counter of replayed requests which weren't in the archive",
+)
+
+# Headers describing the body as it was sent, not as it's archived
+UNARCHIVED_HEADERS = [
+    "content-encoding",
+    "content-length",
+    "transfer-encoding",
+]
+
+
+class ResponseArchive:
+    """
+    Upstream responses by method and URL, in a gzipped JSON lines file.
+
+    Recorded responses are appended as they arrive, so an interrupted
+    recording keeps everything up to the last response. When a URL was
+    recorded more than once, the latest response is replayed.
+
+    Every worker appends to the same archive, so each response is
+    written whole, as its own gzip member, while holding a lock on it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # (method, url) -> (status, reason, headers, body)
+        self.responses = {}
+        self._file = None
+        self._lock = threading.Lock()
+
+        self._load()
+
+    def get(self, method, url):
+        return self.responses.get((method, url))
+
+    def add(self, request, response):
+        headers = {
+            name: value
+            for name, value in response.headers.items()
+            if name.lower() not in UNARCHIVED_HEADERS
+        }
+        record = {
+            "method": request.method,
+            "url": request.url,
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": headers,
+            "body": base64.b64encode(response.content).decode("ascii"),
+        }
+
+        data = gzip.compress((json.dumps(record) + "\n").encode("utf-8"))
+
+        with self._lock:
+            if not self._file:
+                self._file = open(self.path, "ab")
+                atexit.register(self.close)
+
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+
+            try:
+                self._file.write(data)
+                self._file.flush()
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+            self.responses[(request.method, request.url)] = (
+                response.status_code,
+                response.reason,
+                CaseInsensitiveDict(headers),
+                response.content,
+            )
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def _load(self):
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as archive_file:
+                for line in archive_file:
+                    record = json.loads(line)
+                    self.responses[(record["method"], record["url"])] = (
+                        record["status"],
+                        record["reason"],
+                        CaseInsensitiveDict(record["headers"]),
+                        base64.b64decode(record["body"]),
+                    )
+        except FileNotFoundError:
+            pass
+        except (EOFError, ValueError, OSError, zlib.error):
+            # An interrupted or damaged recording (e.g. gzip.BadGzipFile),
+            # so keep the responses before it
+            pass
+
+
+class RecordingAdapter(BaseAdapter):
+    """
+    Send requests with another adapter,
+    saving each response it gets to the archive
+    """
+
+    def __init__(self, adapter, archive):
+        super().__init__()
+
+        self.adapter = adapter
+        self.archive = archive
+
+    def send(self, request, **kwargs):
+        response = self.adapter.send(request, **kwargs)
+
+        # A 304 only makes sense alongside the response it confirms
+        if response.status_code != 304:
+            self.archive.add(request, response)
+
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Answer requests only from the archive, without the network.
+    Conditional requests get a 304 if they match the archived ETag.
+    """
+
+    def __init__(self, archive):
+        super().__init__()
+
+        self.archive = archive
+
+    def send(self, request, **kwargs):
+        recorded = self.archive.get(request.method, request.url)
+
+        if recorded is None:
+            archive_misses.inc()
+
+            raise requests.exceptions.ConnectionError(
+                "Not in the archive: {} {}".format(
+                    request.method, request.url
+                ),
+                request=request,
+            )
+
+        status, reason, headers, body = recorded
+        etag = headers.get("ETag")
+
+        if etag and request.headers.get("If-None-Match") == etag:
+            status, reason, body = 304, "Not Modified", b""
+
+        response = requests.Response()
+        response.status_code = status
+        response.reason = reason
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(body)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+
+        return response
+
+    def close(self):
+        pass
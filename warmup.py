@@ -0,0 +1,220 @@
+# Core
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+# Third-party
+import prometheus_client
+
+# Local
+import related
+import taxonomy
+import timing
+from cache import open_private_file, private_directory
+
+
+# Prometheus metric exporters
+warmup_duration_seconds = prometheus_client.Histogram(
+    "warmup_duration_seconds",
+    "Time taken to warm up a worker's cache after it starts",
+    buckets=[1, 2, 5, 10, 20, 30, 60],
+)
+warmup_requests = prometheus_client.Counter(
+    "warmup_requests",
+    "A counter of pages rendered to warm up the cache, by outcome",
+    ["outcome"],
+)
+
+# Warm-up settings
+# When a worker starts (see gunicorn.conf.py), load the taxonomies and
+# the related posts index, and prefetch the pages below with
+# WARMUP_MAX_WORKERS threads.
+# A worker is warm once they've all been fetched, or after
+# WARMUP_TIMEOUT_SECONDS. Each warm worker leaves a marker file, so that
+# /status/ready, from any worker, only reports ready once every worker is.
+# Set WARMUP=false to disable.
+enabled = os.environ.get("WARMUP", "true").lower() in ["true", "1"]
+timeout = int(os.environ.get("WARMUP_TIMEOUT_SECONDS", 30))
+max_workers = int(os.environ.get("WARMUP_MAX_WORKERS", 8))
+
+# Every group, category and tag
+TAXONOMIES = [taxonomy.groups, taxonomy.categories, taxonomy.tags]
+
+# Rendering these fills the cache with every API response they need
+PAGE_PATHS = [
+    "/",
+    "/cloud-and-server",
+    "/internet-of-things",
+    "/desktop",
+    "/press-centre",
+    "/topics/design",
+    "/topics/juju",
+    "/topics/maas",
+    "/topics/snappy",
+]
+
+_ready = threading.Event()
+_ready.set()
+_deadline = 0
+# The directory of markers for the workers of this worker's master process,
+# and how many workers it runs
+_marker_dir = None
+_workers = 1
+_all_warm = False
+
+
+def start(app, workers=None):
+    """
+    Start warming up this worker in the background.
+    `is_ready` will be false until it finishes, or times out.
+
+    Given the number of `workers` (e.g. from gunicorn), `is_ready` will
+    also be false until that many workers have finished.
+    """
+
+    global _ready, _deadline, _marker_dir, _workers, _all_warm
+
+    if not enabled:
+        return
+
+    # A new event, so an earlier warm-up can't set it
+    _ready = threading.Event()
+    _deadline = time.time() + timeout
+    _all_warm = False
+    _marker_dir = None
+
+    if workers:
+        try:
+            _marker_dir = _prepare_marker_dir()
+            _workers = workers
+        except OSError as marker_error:
+            logging.getLogger(__name__).warning(
+                "Only reporting this worker's readiness: {}".format(
+                    str(marker_error)
+                )
+            )
+
+    threading.Thread(target=_warm_up, args=(app, _ready), daemon=True).start()
+
+
+def is_ready():
+    """
+    Whether this worker is warm, and if it knows of other workers,
+    whether they all are. Once they have all been warm, a worker stays
+    ready, even while one which replaced another is warming up.
+    """
+
+    global _all_warm
+
+    if _marker_dir is None:
+        return _ready.is_set() or time.time() >= _deadline
+
+    if not _all_warm:
+        _all_warm = _count_warm_workers() >= _workers
+
+    return _all_warm
+
+
+def _prepare_marker_dir():
+    marker_dir = os.path.join(
+        private_directory("insights-cache"), "warm-{}".format(os.getppid())
+    )
+    os.makedirs(marker_dir, mode=0o700, exist_ok=True)
+
+    # Left by an earlier worker with the same process ID
+    try:
+        os.remove(os.path.join(marker_dir, str(os.getpid())))
+    except FileNotFoundError:
+        pass
+
+    return marker_dir
+
+
+def _marker_path():
+    return os.path.join(_marker_dir, str(os.getpid()))
+
+
+def _mark_warm():
+    try:
+        os.close(open_private_file(_marker_path(), os.O_WRONLY | os.O_CREAT))
+    except OSError as marker_error:
+        logging.getLogger(__name__).warning(
+            "Failed to mark the worker as warm: {}".format(str(marker_error))
+        )
+
+
+def _count_warm_workers():
+    """
+    The number of running workers with a marker
+    """
+
+    try:
+        pids = os.listdir(_marker_dir)
+    except OSError:
+        return 0
+
+    warm = 0
+
+    for pid in pids:
+        try:
+            os.kill(int(pid), 0)
+        except (ValueError, ProcessLookupError):
+            # Not a marker, or the worker has stopped
+            continue
+        except PermissionError:
+            # Running, as another user
+            pass
+
+        warm += 1
+
+    return warm
+
+
+def _warm_up(app, ready):
+    logger = logging.getLogger(__name__)
+    started = time.time()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    client = app.test_client()
+
+    try:
+        futures = [executor.submit(index.refresh) for index in TAXONOMIES]
+        futures.append(executor.submit(related.index.sync))
+        futures += [
+            executor.submit(_prefetch_page, client, path)
+            for path in PAGE_PATHS
+        ]
+
+        done, not_done = wait(futures, timeout=_deadline - time.time())
+
+        if not_done:
+            logger.warning(
+                "Warm-up timed out with {} requests outstanding".format(
+                    len(not_done)
+                )
+            )
+    finally:
+        executor.shutdown(wait=False)
+        ready.set()
+
+        if _marker_dir and ready is _ready:
+            _mark_warm()
+
+    warmup_duration_seconds.observe(time.time() - started)
+
+
+def _prefetch_page(client, path):
+    try:
+        response = client.get(
+            path, environ_base={timing.UNRECORDED_ENVIRON_KEY: True}
+        )
+    except Exception as request_error:
+        logging.getLogger(__name__).warning(
+            "Failed to warm up {}: {}".format(path, str(request_error))
+        )
+        outcome = "failed"
+    else:
+        outcome = "succeeded" if response.status_code == 200 else "failed"
+
+    warmup_requests.labels(outcome=outcome).inc()